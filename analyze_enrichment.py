@@ -2,8 +2,10 @@
 This file contains methods for analyzing enrichment scores for gene_sets across phenotypes
 '''
 
+import numpy as np
 import scipy.stats as stats
 from cache_codec import counter
+from data_models import gene_set_collection
 
 def analyze_phenotype_score_dist(enrichment_scores, phenotype, gene_set):
     '''
@@ -74,6 +76,50 @@ def rank_by_t_test(enrichment_scores, phenotypes):
 
     return rankings
 
+def rank_by_t_test_masks(enrichment_scores, ids, masks, samples=None, trials=None):
+    '''
+    As rank_by_t_test, but the phenotype of every trial is a boolean mask over the given id's, True for class 1, as
+    returned by data_models.phenotype_store or cache_codec.iterate_sim_phenotypes. Every gene set is tested at once
+    per trial, and trials are consumed one at a time so masks may be generated lazily.
+
+    :param enrichment_scores: a mapping of gene_set names to a dictionary mapping id's to their enrichment scores for \
+    the gene_set
+    :type enrichment_scores: dict
+
+    :param ids: the id's of the columns of masks
+    :type ids: list
+
+    :param masks: the boolean phenotype of every trial over ids, such as the rows of a trials x len(ids) array
+    :type masks: iterable
+
+    :param samples: a trials x k array of the columns of masks each trial is restricted to, every column if None
+    :type samples: numpy.ndarray
+
+    :param trials: the number of trials in masks, needed when masks is a generator
+    :type trials: int
+
+    :returns: a list of maps, one per trial in masks, mapping gene_sets to a tuple of representing t-score and p-value
+    '''
+    gene_sets = [gene_set for gene_set in enrichment_scores.keys()]
+    scores = np.array([[enrichment_scores[gene_set][id] for id in ids] for gene_set in gene_sets])
+    if trials is None:
+        trials = len(masks)
+
+    rankings = []
+    count = counter()
+    for trial, mask in enumerate(masks):
+        columns = np.arange(len(ids)) if samples is None else samples[trial]
+        phenotype = mask[columns]
+
+        #rank gene sets per trial
+        tstats, pvalues = stats.ttest_ind(scores[:, columns[~phenotype]], scores[:, columns[phenotype]], axis=1,
+                                          nan_policy='raise', equal_var=False)
+        rankings.append({gene_set: (abs(tstats[i]), pvalues[i]) for i, gene_set in enumerate(gene_sets)})
+
+        print("\t\tFinished t test for trial " + count.count() + " out of " + str(trials))
+
+    return rankings
+
 def rank_by_t_test_keyed(enrichment_scores, phenotypes, master_gene):
     '''
     As rank_by_t_test, but returns a map mapping of the given master_gene to the results.
@@ -92,7 +138,7 @@ def evaluate_rankings(rankings, gene_sets, master_gene):
     seperating the two classes
     :type rankings: list
 
-    :param gene_sets: a mapping of gene_set names to gene_sets
+    :param gene_sets: a mapping of gene_set names to gene_sets, or a data_models.gene_set_collection
     :type gene_sets: dict
 
     :param master_gene: the master_gene to which we expect to show up in the top k-rankings
@@ -102,6 +148,9 @@ def evaluate_rankings(rankings, gene_sets, master_gene):
     rankings
     '''
 
+    if isinstance(gene_sets, gene_set_collection):
+        return evaluate_rankings_matrix(rankings, gene_sets, master_gene)
+
     #current method for determining the avg. placement of master genes
     def linear_method(ranking):
         # parse gene_sets in order from high tstat to low
@@ -146,6 +195,53 @@ def evaluate_rankings(rankings, gene_sets, master_gene):
 
     return master_gene_ranks
 
+def evaluate_rankings_matrix(rankings, gene_sets, master_gene):
+    '''
+    As evaluate_rankings, but over a data_models.gene_set_collection. The average placement of every gene is found
+    with sparse matrix products per ranking instead of looping over the genes of every set. Genes with the same
+    average placement are ordered by the first set they appear in, then by their gene id.
+
+    :param rankings: a list mapping of gene_sets to tuples containg the tstatistic and pvalue of the gene set in \
+    seperating the two classes
+    :type rankings: list
+
+    :param gene_sets: the gene sets the rankings were made over
+    :type gene_sets: data_models.gene_set_collection
+
+    :param master_gene: the master_gene to which we expect to show up in the top k-rankings
+    :type master_gene: str
+
+    :returns: a list, with each element being the rank of the master_gene in the given rankings
+    '''
+    if master_gene not in gene_sets.gene_index:
+        return []
+    master = gene_sets.gene_index[master_gene]
+    by_gene = gene_sets.matrix.T.tocsr()
+
+    master_gene_ranks = []
+    for ranking in rankings:
+        # placement of every set, from high tstat to low, 0 for sets not in the ranking
+        sorted_sets = sorted(ranking, key=ranking.get, reverse=True)
+        placements = np.zeros(len(gene_sets))
+        placements[[gene_sets.set_index[set] for set in sorted_sets]] = np.arange(1, len(sorted_sets) + 1)
+
+        running_scores = by_gene @ placements
+        set_count = by_gene @ (placements > 0)
+
+        ranked = np.flatnonzero(set_count)
+        if set_count[master] == 0:
+            continue
+
+        # the best placed set of every gene, which decides the order genes were first seen in
+        first_seen = len(gene_sets) + 1 - by_gene.multiply(np.where(placements > 0, len(gene_sets) + 1 - placements, 0))\
+                                                 .max(axis=1).toarray().ravel()
+
+        final_scores = running_scores[ranked] / set_count[ranked]
+        sorted_genes = ranked[np.lexsort((ranked, first_seen[ranked], final_scores))]
+        master_gene_ranks.append(int(np.flatnonzero(sorted_genes == master)[0]) + 1)
+
+    return master_gene_ranks
+
 def evaluate_rankings_keyed(rankings, gene_sets, master_gene):
     '''
     As above, but returns the value in a map keyed to the given master_gene
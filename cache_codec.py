@@ -10,6 +10,7 @@ is more appropriate for most of the applications.
 import os
 import pickle
 import sqlite3
+import numpy as np
 from data_models import *
 from functools import lru_cache
 
@@ -35,6 +36,20 @@ DATASETS = {"BC"}
 #CHange this to change the directory will data dumps will be stored and read from
 DATA_DIR = os.getcwd() + "/Data/AppCache"
 
+def is_stale(path, sources):
+    '''
+    Returns True if the cache file at path is missing or older than any of the existing files it is built from
+
+    :param path: the path of the cache file
+    :type path: str
+
+    :param sources: the paths of the files the cache is built from
+    :type sources: list
+    '''
+    if not os.path.exists(path):
+        return True
+    return any(os.path.getmtime(source) > os.path.getmtime(path) for source in sources if os.path.exists(source))
+
 '''
 ****************************Downloading expression data****************************
 '''
@@ -111,62 +126,381 @@ def load_sample_profiles(dataset):
     print("\tSaved expression data!")
     return load_sample_profiles(dataset)
 
+EXPRESSION_MATRIX_FILE = lambda dataset: EXPRESSION_PROFILES_DIR(dataset) + dataset + "_ExpressionMatrix.pkl"
+'''Returns the path used to cache/uncache the genes x samples expression matrix for the given dataset'''
+
+def dump_expression_matrix(dataset):
+    '''
+    From the sample profiles of the given dataset, dumps a data_models.expression_matrix with one row per gene and one
+    column per sample. Genes are ordered as they appear in the first sample.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+    '''
+    if not os.path.exists(EXPRESSION_PROFILES_DIR(dataset)):
+        os.makedirs(EXPRESSION_PROFILES_DIR(dataset))
+
+    samples = load_sample_profiles(dataset)
+    ids = [key for key in samples.keys()]
+    genes = [gene for gene in samples[ids[0]].profiles.keys()]
+
+    values = np.empty((len(genes), len(ids)))
+    for column, id in enumerate(ids):
+        profile = samples[id].profiles
+        values[:, column] = [profile[gene].intensity for gene in genes]
+
+    pickle.dump(expression_matrix(genes, ids, values), open(EXPRESSION_MATRIX_FILE(dataset), 'wb'), protocol=-1)
+
+@lru_cache(maxsize=16)
+def load_expression_matrix(dataset):
+    '''
+    Returns the expression data of the dataset as a genes x samples matrix, caching information along the way.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+
+    :returns: a data_models.expression_matrix
+    '''
+    if os.path.exists(EXPRESSION_MATRIX_FILE(dataset)):
+        print("\tOpenning cached expression matrix!")
+        return pickle.load(open(EXPRESSION_MATRIX_FILE(dataset), 'rb'))
+
+    print("\tCalculating expression matrix!")
+    dump_expression_matrix(dataset)
+    print("\tSaved expression matrix!")
+    return load_expression_matrix(dataset)
+
+GENE_STATS_FILE = lambda dataset: EXPRESSION_PROFILES_DIR(dataset) + dataset + "_GeneStats.npy"
+'''Returns the path used to cache/uncache the per gene expression statistics, in expression matrix gene order'''
+GENE_STATS_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+def calculate_gene_stats(values):
+    '''
+    Summarizes the expression of every gene of a genes x samples matrix.
+
+    :param values: a genes x samples array of expression levels
+    :type values: numpy.ndarray
+
+    :returns: a structured array with one record per gene holding its min, max, mean, sd and the quantiles listed in
+              GENE_STATS_QUANTILES
+    '''
+    stats = np.empty(len(values), dtype=[('min', 'f8'), ('max', 'f8'), ('mean', 'f8'), ('sd', 'f8'),
+                                         ('quantiles', 'f8', (len(GENE_STATS_QUANTILES),))])
+    stats['min'] = values.min(axis=1)
+    stats['max'] = values.max(axis=1)
+    stats['mean'] = values.mean(axis=1)
+    stats['sd'] = values.std(axis=1)
+    stats['quantiles'] = np.quantile(values, GENE_STATS_QUANTILES, axis=1).T
+    return stats
+
+def normalize_expressions(values, stats):
+    '''
+    Transforms a genes x samples matrix of expression levels into values between 0 and 1, gene by gene, mapping the
+    gene's max to 1 and the lower of its min and 0 to 0.
+
+    :param values: a genes x samples array of expression levels
+    :type values: numpy.ndarray
+
+    :param stats: the statistics of the genes of values, as returned by calculate_gene_stats
+    :type stats: numpy.ndarray
+
+    :returns: a genes x samples array of normalized expression levels
+    '''
+    lower = np.minimum(stats['min'], 0)[:, np.newaxis]
+    upper = stats['max'][:, np.newaxis]
+    return (values - lower) / (upper - lower)
+
+def dump_gene_stats(dataset):
+    '''
+    Dumps the statistics of every gene of the dataset's expression matrix (see calculate_gene_stats).
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+    '''
+    if not os.path.exists(EXPRESSION_PROFILES_DIR(dataset)):
+        os.makedirs(EXPRESSION_PROFILES_DIR(dataset))
+
+    np.save(GENE_STATS_FILE(dataset), calculate_gene_stats(load_expression_matrix(dataset).values))
+
+@lru_cache(maxsize=16)
+def load_gene_stats(dataset):
+    '''
+    Returns the statistics of every gene of the dataset, caching information along the way.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+
+    :returns: a structured array as returned by calculate_gene_stats, in expression matrix gene order
+    '''
+    if os.path.exists(GENE_STATS_FILE(dataset)):
+        print("\tOpenning cached gene statistics!")
+        return np.load(GENE_STATS_FILE(dataset))
+
+    print("\tCalculating gene statistics!")
+    dump_gene_stats(dataset)
+    print("\tSaved gene statistics!")
+    return load_gene_stats(dataset)
+
+'''
+****************************Gene ranks****************************
+'''
+from random_streams import DEFAULT_SEED
+SEED_TAG = lambda tag, seed: tag + ("_SEED_" + str(seed) + "_" if tag == 'null' else "")
+'''Returns the prefix of the cache files of a tag. 'null' data is scrambled by the run seed, so is cached per seed'''
+
+RANK_INDEX_DIR = lambda dataset: DATA_DIR + "/" + dataset + "/"
+RANK_INDEX_FILE = lambda dataset, tag, seed=DEFAULT_SEED: RANK_INDEX_DIR(dataset) + SEED_TAG(tag, seed) + dataset + \
+                                                          "_RankIndex.pkl"
+'''Returns the path used to cache/uncache the genes, id's and rank weights of the rank index'''
+RANK_MATRIX_FILE = lambda dataset, tag, seed=DEFAULT_SEED: RANK_INDEX_DIR(dataset) + SEED_TAG(tag, seed) + dataset + \
+                                                           "_RankIndex.npy"
+'''Returns the path used to cache/uncache the genes x samples rank matrix of the rank index'''
+
+DEFAULT_OMEGA = 0.25
+'''The weight placed on ranking terms unless another one is asked for'''
+
+from ssGSEA import rank_matrix
+def dump_rank_index(dataset, tag, seed=DEFAULT_SEED):
+    '''
+    Ranks every gene within every sample of the given dataset a single time and dumps the result as a
+    data_models.rank_index. The rank matrix is written as a flat .npy file next to a pickle with everything else.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+
+    :param tag: 'null' to rank scrambled expression data, '' otherwise
+    :type tag: str
+
+    :param seed: the run seed 'null' data is scrambled with (see scramble_matrix)
+    :type seed: int
+    '''
+    if not os.path.exists(RANK_INDEX_DIR(dataset)):
+        os.makedirs(RANK_INDEX_DIR(dataset))
+
+    matrix = load_expression_matrix(dataset)
+
+    if tag == 'null':
+        print("Simulating null hypothesis...")
+        matrix = scramble_matrix(matrix, seed)
+
+    index = rank_index(matrix.genes, matrix.ids, rank_matrix(matrix.values), DEFAULT_OMEGA)
+
+    np.save(RANK_MATRIX_FILE(dataset, tag, seed), index.ranks)
+    index.ranks = None
+    pickle.dump(index, open(RANK_INDEX_FILE(dataset, tag, seed), 'wb'), protocol=-1)
+
+@lru_cache(maxsize=16)
+def load_rank_index(dataset, tag='', seed=DEFAULT_SEED):
+    '''
+    Returns the rank index of the dataset, caching information along the way.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+
+    :returns: a data_models.rank_index
+    '''
+    if os.path.exists(RANK_INDEX_FILE(dataset, tag, seed)) and os.path.exists(RANK_MATRIX_FILE(dataset, tag, seed)):
+        print("\tOpenning cached rank index!")
+        index = pickle.load(open(RANK_INDEX_FILE(dataset, tag, seed), 'rb'))
+        index.ranks = np.load(RANK_MATRIX_FILE(dataset, tag, seed))
+        return index
+
+    print("\tCalculating rank index!")
+    dump_rank_index(dataset, tag, seed)
+    print("\tSaved rank index!")
+    return load_rank_index(dataset, tag, seed)
+
 '''
 ****************************Model fitting****************************
 '''
-from model_fit import get_trained_models
+from model_fit import fit_gene_model_table
+from model_fit import refit_gene_model_table
 GENE_MODELS_DIR = lambda dataset: DATA_DIR + "/" + dataset + "/"
-GENE_MODELS_FILE = lambda dataset: GENE_MODELS_DIR(dataset) + dataset + "_GMM_Models.pkl"
-def dump_gene_models(dataset):
+GENE_MODELS_FILE = lambda dataset: GENE_MODELS_DIR(dataset) + dataset + "_GeneModels.npy"
+GENE_MODEL_CHUNKS_DIR = lambda dataset, chunk_size: GENE_MODELS_DIR(dataset) + dataset + "_GeneModelChunks_" + \
+                                                    str(chunk_size) + "/"
+GENE_MODEL_CHUNK_FILE = lambda dataset, chunk_size, start: GENE_MODEL_CHUNKS_DIR(dataset, chunk_size) + str(start) + ".npy"
+'''Returns the path used to checkpoint the models of the genes of one chunk while training'''
+
+def _fit_gene_model_chunk(chunk):
+    '''
+    Pool worker fitting the models of one chunk of genes, given as a (start, genes, values) tuple. The chunk's start
+    seeds its random initializations so a resumed training fits the chunk the same way.
+    '''
+    start, genes, values = chunk
+    return start, fit_gene_model_table(genes, values, seed=start).records()
+
+def dump_gene_models(dataset, jobs=1, chunk_size=1000):
     '''
-    Utilizing sample information, uses expression levels across samples for genes in order to train a GMM
-    model for every gene. Ultimately dumps a dict of gene names to the GMM model for the gene. This will only
-    train genes which appear in every gene_set!
+    Utilizing sample information, uses expression levels across samples for genes in order to train a gaussian
+    mixture model for every gene. Ultimately dumps the records of a data_models.gene_model_table holding the model of
+    every gene of the dataset's expression matrix.
+
+    Genes are trained in chunks spread over a pool of processes and every finished chunk is checkpointed, so an
+    interrupted training resumes from the chunks it had finished. The checkpoints are removed once every chunk has
+    been merged.
 
     :param dataset: the name of the dataset downloading data from
     :type dataset: str
+
+    :param jobs: the number of processes to train with
+    :type jobs: int
+
+    :param chunk_size: the number of genes trained and checkpointed together
+    :type chunk_size: int
     '''
+    import time
+
+    if not os.path.exists(GENE_MODEL_CHUNKS_DIR(dataset, chunk_size)):
+        os.makedirs(GENE_MODEL_CHUNKS_DIR(dataset, chunk_size))
+
+    matrix = load_expression_matrix(dataset)
+    starts = range(0, len(matrix.genes), chunk_size)
+
+    #only train the chunks without a checkpoint of the same genes
+    pending = []
+    for start in starts:
+        genes = matrix.genes[start:start + chunk_size]
+        if os.path.exists(GENE_MODEL_CHUNK_FILE(dataset, chunk_size, start)):
+            if np.load(GENE_MODEL_CHUNK_FILE(dataset, chunk_size, start))['gene'].tolist() == genes:
+                continue
+        pending.append((start, genes, matrix.values[start:start + chunk_size]))
+
+    print("\tTraining model for every gene... " + str(len(starts) - len(pending)) + " out of " + str(len(starts)) +
+          " chunks already trained")
+
+    if jobs > 1:
+        from multiprocessing import Pool
+
+        pool = Pool(processes=jobs)
+        chunks = pool.imap_unordered(_fit_gene_model_chunk, pending)
+    else:
+        chunks = map(_fit_gene_model_chunk, pending)
+
+    begin = time.time()
+    trained = 0
+    total = sum([len(chunk[1]) for chunk in pending])
+    try:
+        for start, records in chunks:
+            path = GENE_MODEL_CHUNK_FILE(dataset, chunk_size, start)
+            np.save(path + ".tmp.npy", records)
+            os.replace(path + ".tmp.npy", path)
+
+            trained += len(records)
+            elapsed = time.time() - begin
+            print("\t\tTrained " + str(trained) + " out of " + str(total) + " genes, " +
+                  str(round(trained / elapsed, 1)) + " genes/s")
+    finally:
+        #every chunk is consumed or failed by now, so stop the workers either way
+        if jobs > 1:
+            pool.terminate()
+            pool.join()
+
+    records = np.concatenate([np.load(GENE_MODEL_CHUNK_FILE(dataset, chunk_size, start)) for start in starts])
+    np.save(GENE_MODELS_FILE(dataset), records)
+
+    for start in starts:
+        os.remove(GENE_MODEL_CHUNK_FILE(dataset, chunk_size, start))
+    os.rmdir(GENE_MODEL_CHUNKS_DIR(dataset, chunk_size))
+
+def refit_gene_models(dataset, iterations=20, threshold=0.05):
+    '''
+    Refits the cached gene models of the dataset to its current expression matrix, for instance once samples have
+    been added to the cohort (see model_fit.refit_gene_model_table). The cached models are replaced atomically, so
+    readers only ever see the old or the new table. Everything cached from the old models, the model statistics, best
+    models and simulated phenotypes, is removed so it is calculated again from the new ones.
 
-    if not os.path.exists(GENE_MODELS_DIR(dataset)):
-        os.makedirs(GENE_MODELS_DIR(dataset))
+    :requires: the expression matrix cache has been dumped again from the grown cohort
 
-    samples = load_sample_profiles(dataset)
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
 
-    #map gene names -> list of expression intensities
-    expressions = {}
-    keys = [key for key in samples.keys()]
-    genes = samples[keys[0]].profiles.keys()
-    for gene in genes:
-        expressions[gene] = []
+    :param iterations: the maximum number of E/M steps warm started from the cached models
+    :type iterations: int
 
-    for id in samples.keys():
-        sample = samples[id]
-        for gene in sample.profiles.keys():
-            if gene in genes:
-                expressions[gene].append(sample.profiles[gene].intensity)
+    :param threshold: the change in mean log likelihood past which a gene is fitted from scratch
+    :type threshold: float
+    '''
+    matrix = load_expression_matrix(dataset)
+    models = load_gene_models(dataset)
+
+    print("\tRefitting model for every gene...")
+    models = refit_gene_model_table(models, matrix.genes, matrix.values, iterations, threshold)
 
-    models = get_trained_models(expressions)
+    np.save(GENE_MODELS_FILE(dataset) + ".tmp.npy", models.records())
+    os.replace(GENE_MODELS_FILE(dataset) + ".tmp.npy", GENE_MODELS_FILE(dataset))
+    load_gene_models.cache_clear()
 
-    pickle.dump(models, open(GENE_MODELS_FILE(dataset), 'wb'), protocol=-1)
+    if os.path.exists(MODEL_STATISTICS_FILE(dataset)):
+        os.remove(MODEL_STATISTICS_FILE(dataset))
+    for directory, prefix in [(BEST_MODELS_DIR(dataset, None, None), dataset + "_BestModels_BINS_"),
+                              (PHENOTYPE_STORE_DIR(dataset), dataset + "_SimPhenoStore_N_")]:
+        for name in os.listdir(directory):
+            if name.startswith(prefix):
+                os.remove(directory + name)
+
+    load_model_statistics.cache_clear()
+    load_best_models.cache_clear()
+    load_sim_phenotype_store.cache_clear()
+    load_phenotype_posterior.cache_clear()
 
 @lru_cache(maxsize=16)
-def load_gene_models(dataset):
+def load_gene_models(dataset, jobs=1):
     '''
-    Returns gene models of the dataset, caching information along the way.
+    Returns gene models of the dataset, caching information along the way. The models are memory mapped from the
+    cache rather than read into memory.
 
     :param dataset: the name of the dataset downloading data from
     :type dataset: str
 
-    :return: a dict mapping gene names to the trained model of the gene
+    :param jobs: the number of processes to train with if the models are not cached
+    :type jobs: int
+
+    :return: a data_models.gene_model_table mapping gene names to the trained model of the gene
     '''
     if os.path.exists(GENE_MODELS_FILE(dataset)):
         print("\tOpenning models!")
-        return pickle.load(open(GENE_MODELS_FILE(dataset), 'rb'))
+        return gene_model_table.from_records(np.load(GENE_MODELS_FILE(dataset), mmap_mode='r'))
 
     print("\tCalculating GMM data!")
-    dump_gene_models(dataset)
+    dump_gene_models(dataset, jobs)
     print("\tSaving GMM data")
-    return load_gene_models(dataset)
+    return load_gene_models(dataset, jobs)
+
+MODEL_STATISTICS_FILE = lambda dataset: GENE_MODELS_DIR(dataset) + dataset + "_GeneModelStatistics.npy"
+'''Returns the path used to cache/uncache the model selection statistics of every gene model'''
+from master_selection import calculate_model_statistics
+def dump_model_statistics(dataset):
+    '''
+    Dumps the model selection statistics of every gene model of the dataset (see
+    master_selection.calculate_model_statistics).
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+    '''
+    models = load_gene_models(dataset)
+    matrix = load_expression_matrix(dataset)
+    values = matrix.values[[matrix.gene_index[gene] for gene in models.genes]]
+
+    np.save(MODEL_STATISTICS_FILE(dataset), calculate_model_statistics(models, values))
+
+@lru_cache(maxsize=16)
+def load_model_statistics(dataset):
+    '''
+    Returns the model selection statistics of every gene model of the dataset, caching information along the way.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+
+    :returns: a structured array as returned by master_selection.calculate_model_statistics
+    '''
+    if os.path.exists(MODEL_STATISTICS_FILE(dataset)):
+        print("\tOpenning cached model statistics!")
+        return np.load(MODEL_STATISTICS_FILE(dataset))
+
+    print("\tCalculating model statistics!")
+    dump_model_statistics(dataset)
+    print("\tSaving model statistics!")
+    return load_model_statistics(dataset)
 
 '''
 ****************************Gene popularity****************************
@@ -182,8 +516,9 @@ GENE_POPULARITY_FILE = lambda dataset: GENE_POPULARITY_DIR(dataset) + dataset +
 
 def dump_gene_popularity(dataset):
     '''
-    Queries the database of the given dataset and dumps a pickled file containing gene popularity data. The pickled
-    file will contain a dictionary mapping gene name to popularity score
+    Queries the database of the given dataset and dumps a pickled file containing gene popularity data, the number
+    of ALL gene sets every gene appears in. The pickled file will contain a dictionary mapping gene name to
+    popularity score
 
     :param dataset: the name of the dataset downloading data from
     :type dataset: str
@@ -201,16 +536,10 @@ def dump_gene_popularity(dataset):
 
     gene_names = [row[0] for row in rows]
 
-    #then query gene set db for popularity
-    count = counter()
-    cursor = sqlite3.connect(GENE_SET_DB).cursor()
-    gene_pop = {}
-    for names in gene_names:
-        cursor.execute("Select GeneSet From " + GENE_SET_GENE_TABLE + " WHERE Gene='%s'" % names)
-        gene_pop[names] = len(cursor.fetchall())
-        print("\t\tCalcuated populairty for gene " + str(count.count()) + " out of " + str(len(gene_names)))
+    #then look up every gene's popularity in the gene set index
+    index = load_gene_set_index()
+    gene_pop = {names: index.popularity(names) for names in gene_names}
 
-    cursor.close()
     pickle.dump(gene_pop, open(GENE_POPULARITY_FILE(dataset), 'wb'), protocol=-1)
 
 @lru_cache(maxsize=16)
@@ -280,6 +609,33 @@ def load_all_gene_sets():
     print("\tSaving gene sets!")
     return load_all_gene_sets()
 
+GENE_SET_INDEX_FILE = GENE_SET_DIR + "/All_GeneSetIndex.pkl"
+def dump_gene_set_index():
+    '''
+    Dumps a data_models.gene_set_index mapping every gene of ALL gene sets to the sets containing it, built in one
+    pass over the gene sets.
+    '''
+    gene_sets = load_all_gene_sets()
+    genes = sorted({gene for name in gene_sets for gene in gene_sets[name].genes})
+
+    pickle.dump(gene_set_index(gene_set_collection(gene_sets, genes)), open(GENE_SET_INDEX_FILE, 'wb'), protocol=-1)
+
+@lru_cache(maxsize=16)
+def load_gene_set_index():
+    '''
+    Returns the index of the sets containing every gene of ALL gene sets, caching information along the way.
+
+    :returns: a data_models.gene_set_index
+    '''
+    if os.path.exists(GENE_SET_INDEX_FILE):
+        print("\tOpenning cached gene set index!")
+        return pickle.load(open(GENE_SET_INDEX_FILE, 'rb'))
+
+    print("\tCalculating gene set index!")
+    dump_gene_set_index()
+    print("\tSaving gene set index!")
+    return load_gene_set_index()
+
 FILTERED_GENE_SET_DIR = lambda dataset: DATA_DIR + "/" + dataset + "/"
 FILTERED_GENE_SET_FILE = lambda dataset: FILTERED_GENE_SET_DIR(dataset) + dataset + "_FilteredGeneSets.pkl"
 '''Returns the path used to cache/uncache expression profiles for the given dataset'''
@@ -302,6 +658,23 @@ def dump_filtered_gene_sets(dataset):
     keys = [key for key in samples.keys()]
     valid_genes = samples[keys[0]].profiles.keys()
 
+    filtered_sets = filter_gene_sets(gene_sets, valid_genes)
+
+    pickle.dump(filtered_sets, open(FILTERED_GENE_SET_FILE(dataset), 'wb'), protocol=-1)
+
+def filter_gene_sets(gene_sets, valid_genes):
+    '''
+    Returns the given gene_sets restricted to the valid genes, keeping only the sets left with more than 5 and less
+    than 100 genes.
+
+    :param gene_sets: a dict mapping geneset names to their gene_set objects
+    :type gene_sets: dict
+
+    :param valid_genes: the genes of the dataset, as a set or dict keys
+    :type valid_genes: set
+
+    :returns: a dict mapping geneset names to their filtered gene_set objects
+    '''
     filtered_sets = {}
     count = counter()
     for set_name in gene_sets:
@@ -311,7 +684,7 @@ def dump_filtered_gene_sets(dataset):
             filtered_sets[set_name] = gene_set(set_name, cur_set.url, new_genes)
         print("\t\tProcessed set " + str(count.count()) + " out of " + str(len(gene_sets)))
 
-    pickle.dump(filtered_sets, open(FILTERED_GENE_SET_FILE(dataset), 'wb'), protocol=-1)
+    return filtered_sets
 
 @lru_cache(maxsize=16)
 def load_filtered_gene_sets(dataset):
@@ -330,6 +703,73 @@ def load_filtered_gene_sets(dataset):
     print("\tSaving filtered gene sets!")
     return load_filtered_gene_sets(dataset)
 
+FILTERED_GENE_SET_COLLECTION_FILE = lambda dataset: FILTERED_GENE_SET_DIR(dataset) + dataset + \
+                                                    "_FilteredGeneSetCollection.pkl"
+'''Returns the path used to cache/uncache the filtered gene sets as a sparse gene_set_collection'''
+def dump_filtered_gene_set_collection(dataset):
+    '''
+    Dumps the filtered gene sets of the given dataset as a data_models.gene_set_collection, whose gene id's are the
+    rows of the dataset's expression matrix.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+    '''
+    if not os.path.exists(FILTERED_GENE_SET_DIR(dataset)):
+        os.makedirs(FILTERED_GENE_SET_DIR(dataset))
+
+    gene_sets = load_filtered_gene_sets(dataset)
+    genes = load_expression_matrix(dataset).genes
+
+    collection = gene_set_collection(gene_sets, genes)
+
+    pickle.dump(collection, open(FILTERED_GENE_SET_COLLECTION_FILE(dataset), 'wb'), protocol=-1)
+
+@lru_cache(maxsize=16)
+def load_filtered_gene_set_collection(dataset):
+    '''
+    Returns gene sets valid for the given dataset as a sparse incidence matrix, caching information along the way.
+
+    :returns: a data_models.gene_set_collection
+    '''
+
+    if os.path.exists(FILTERED_GENE_SET_COLLECTION_FILE(dataset)):
+        print("\tOpenning cached gene set collection!")
+        return pickle.load(open(FILTERED_GENE_SET_COLLECTION_FILE(dataset), 'rb'))
+
+    print("\tCalculating filtered gene set collection!")
+    dump_filtered_gene_set_collection(dataset)
+    print("\tSaving filtered gene set collection!")
+    return load_filtered_gene_set_collection(dataset)
+
+FILTERED_GENE_SET_INDEX_FILE = lambda dataset: FILTERED_GENE_SET_DIR(dataset) + dataset + "_FilteredGeneSetIndex.pkl"
+'''Returns the path used to cache/uncache the index of the filtered gene sets containing every gene'''
+def dump_filtered_gene_set_index(dataset):
+    '''
+    Dumps a data_models.gene_set_index mapping every gene of the given dataset to the filtered gene sets containing it.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+    '''
+    index = gene_set_index(load_filtered_gene_set_collection(dataset))
+    pickle.dump(index, open(FILTERED_GENE_SET_INDEX_FILE(dataset), 'wb'), protocol=-1)
+
+@lru_cache(maxsize=16)
+def load_filtered_gene_set_index(dataset):
+    '''
+    Returns the index of the filtered gene sets containing every gene of the given dataset, caching information
+    along the way.
+
+    :returns: a data_models.gene_set_index
+    '''
+    if os.path.exists(FILTERED_GENE_SET_INDEX_FILE(dataset)):
+        print("\tOpenning cached gene set index!")
+        return pickle.load(open(FILTERED_GENE_SET_INDEX_FILE(dataset), 'rb'))
+
+    print("\tCalculating filtered gene set index!")
+    dump_filtered_gene_set_index(dataset)
+    print("\tSaving filtered gene set index!")
+    return load_filtered_gene_set_index(dataset)
+
 '''
 ****************************Dataset specific clinical profiles****************************
 '''
@@ -398,55 +838,33 @@ BEST_MODELS_DIR = lambda dataset, bins, genes: DATA_DIR + "/" + dataset + "/"
 BEST_MODELS_FILE = lambda dataset, bins, genes: BEST_MODELS_DIR(dataset, bins, genes) + dataset + "_BestModels_BINS_" \
                                                 + str(bins) + "_GENES_" + str(genes) + ".pkl"
 '''Returns the path used to cache/uncache gene popularity for the given dataset'''
-import heapq
-from master_selection import calculate_prior
-from master_selection import calculate_bayes_error
-def dump_best_models(dataset, num_bins, genes_per_bin):
+from master_selection import candidate_genes
+from master_selection import select_best_genes
+def dump_best_models(dataset, configurations):
     """
-    Given a dataset, returns the best genes_per_bin which fall into num_bins evenly divided bayes error for the models
+    Given a dataset, dumps the genes_per_bin models with the smallest bayes error in each of num_bins evenly divided
+    prior bins, for every given (num_bins, genes_per_bin) configuration. Only genes which appear in a gene set and
+    whose prior is at least 0.1 are picked.
 
-    ToDo: figure out a way to write this better
-    """
-    if not os.path.exists(BEST_MODELS_DIR(dataset, num_bins, genes_per_bin)):
-        os.makedirs(BEST_MODELS_DIR(dataset, num_bins, genes_per_bin))
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
 
+    :param configurations: (num_bins, genes_per_bin) pairs to pick the best models of
+    :type configurations: list
+    """
     gene_models = load_gene_models(dataset)
-    popularity = load_gene_popularity(dataset)
-
-    bin_bounds = [0.1] + [0.1 + x * (0.5 - 0.1) / num_bins for x in range(1, num_bins + 1)]
-    find_bin = lambda prior: num_bins if prior == 0.5 \
-                                else sum([i for i in range(0, len(bin_bounds) - 1)
-                                  if (prior >= bin_bounds[i] and prior < bin_bounds[i + 1])])
-
-    bins = [{} for x in range(0, num_bins)]
-
-    #Here we check every gene fits the criteria and then add it to appropriate bin
-    #bins are maps k : v where k = gene name v = bayes error
-    count = counter()
-    gene_names = gene_models.keys()
-    for gene in gene_names:
-        model = gene_models[gene]
-
-        prior = calculate_prior(model)
-        error = calculate_bayes_error(model)
+    statistics = load_model_statistics(dataset)
+    candidates = candidate_genes(statistics, load_gene_popularity(dataset))
 
-        #pick and get all gene errors
-        if popularity[gene] > 0 and prior >= 0.1:
-            bin = find_bin(prior)
-            bins[bin][gene] = error
+    #best_models is k: v where k = gene name and v = the model of that gene
+    for (num_bins, genes_per_bin), best_genes in select_best_genes(statistics, candidates, configurations).items():
+        if not os.path.exists(BEST_MODELS_DIR(dataset, num_bins, genes_per_bin)):
+            os.makedirs(BEST_MODELS_DIR(dataset, num_bins, genes_per_bin))
 
-        print("Examined gene " + str(count.count()) + " out of " + str(len(gene_names)))
-
-    #then we go through each bin and take the 10 smallest bayes error
-    #bestmodels is k: v where k = gene name and v = bayes error for that model
-    best_models = {}
-    for bin in bins:
-        best_genes = heapq.nsmallest(genes_per_bin, bin, key=bin.get)
-        for best_gene in best_genes:
-            best_models[best_gene] = gene_models[best_gene]
-
-    print(best_models)
-    pickle.dump(best_models, open(BEST_MODELS_FILE(dataset, num_bins, genes_per_bin), 'wb'), protocol=-1)
+        best_models = {gene: gene_models[gene] for gene in statistics['gene'][best_genes].tolist()}
+        print("\t\tPicked " + str(len(best_models)) + " models for " + str(num_bins) + " bins of " +
+              str(genes_per_bin) + " genes")
+        pickle.dump(best_models, open(BEST_MODELS_FILE(dataset, num_bins, genes_per_bin), 'wb'), protocol=-1)
 
 @lru_cache(maxsize=16)
 def load_best_models(dataset, num_bins, genes_per_bin):
@@ -470,25 +888,31 @@ def load_best_models(dataset, num_bins, genes_per_bin):
         return pickle.load(open(BEST_MODELS_FILE(dataset, num_bins, genes_per_bin), 'rb'))
 
     print("\tCalculating best models!")
-    dump_best_models(dataset, num_bins, genes_per_bin)
+    dump_best_models(dataset, [(num_bins, genes_per_bin)])
     print("\tSaving best models!")
     return load_best_models(dataset, num_bins, genes_per_bin)
 
 '''
 ****************************Simulating Phenotypes****************************
 '''
-PHENOTYPE_SIMS_DIR  = lambda dataset, n, master_gene: DATA_DIR + "/" + dataset + "/SimPhenotypes/" + master_gene + "/"
-
-PHENOTYPE_SIMS_FILE = lambda dataset, n, master_gene: PHENOTYPE_SIMS_DIR(dataset, n, master_gene) + \
-                        dataset + "_SimPheno_" + "Gene_" + str(master_gene) + "_N_" + str(n) + ".pkl"
-'''Returns the path used to cache/uncache gene popularity for the given dataset'''
-from simulation import simulate_data
-def dump_sim_phenotypes(dataset, n, master_gene):
+PHENOTYPE_STORE_DIR = lambda dataset: DATA_DIR + "/" + dataset + "/"
+PHENOTYPE_STORE_FILE = lambda dataset, n, seed: PHENOTYPE_STORE_DIR(dataset) + dataset + "_SimPhenoStore_N_" + \
+                                                str(n) + "_SEED_" + str(seed) + ".bin"
+PHENOTYPE_STORE_INDEX_FILE = lambda dataset, n, seed: PHENOTYPE_STORE_DIR(dataset) + dataset + "_SimPhenoStore_N_" + \
+                                                      str(n) + "_SEED_" + str(seed) + ".pkl"
+'''Returns the paths used to cache/uncache the bit-packed phenotypes and their sample id's and master genes'''
+from simulation import simulate_phenotypes
+from random_streams import generator
+def dump_sim_phenotypes(dataset, n, master_genes, seed=DEFAULT_SEED):
     '''
     From the gene expressions and samples of the given dataset, simulates n tables of phenotypes for each sample with
-    the given master_gene.
+    every given master gene which has not been simulated yet.
 
-    Dumps a file of lists of dicts mapping id's to class (0 or 1)
+    The phenotypes of every master gene simulated so far are kept as one data_models.phenotype_store: the bit-packed
+    replicates in a raw file, one block per master gene, and their sample id's and master genes in an index. New
+    master genes are appended to the end of the file, so the genes already stored are never rewritten. Samples are in
+    the order of the dataset's expression matrix. If the samples of the dataset changed since the store was written,
+    it is simulated again from scratch.
 
     In general class 0 has lower gene expression levels of the master gene than class 1.
 
@@ -498,24 +922,140 @@ def dump_sim_phenotypes(dataset, n, master_gene):
     :param n: the number of simulations to run
     :type n: int
 
+    :param master_genes: the master genes used to simulate data
+    :type master_genes: list
+
+    :param seed: the run seed of the simulations (see random_streams)
+    :type seed: int
+    '''
+
+    if not os.path.exists(PHENOTYPE_STORE_DIR(dataset)):
+        os.makedirs(PHENOTYPE_STORE_DIR(dataset))
+
+    models = load_gene_models(dataset)
+    matrix = load_expression_matrix(dataset)
+
+    genes = []
+    if os.path.exists(PHENOTYPE_STORE_INDEX_FILE(dataset, n, seed)):
+        ids, genes = pickle.load(open(PHENOTYPE_STORE_INDEX_FILE(dataset, n, seed), 'rb'))
+        if list(ids) != list(matrix.ids):
+            print("\t\tSamples changed, simulating every master gene again")
+            genes = []
+
+    new_genes = [gene for gene in dict.fromkeys(master_genes) if gene not in genes]
+    block = n * ((len(matrix.ids) + 7) // 8)
+
+    #only the genes in the index are trusted, so drop whatever an interrupted append left past them
+    with open(PHENOTYPE_STORE_FILE(dataset, n, seed), 'ab') as store:
+        store.truncate(len(genes) * block)
+
+        count = counter()
+        for master_gene in new_genes:
+            labels = simulate_phenotypes(models[master_gene], matrix.values[matrix.gene_index[master_gene]], n,
+                                         master_gene, seed)
+            store.write(phenotype_store.pack(labels).tobytes())
+            print("\t\tSimulated phenotypes for gene " + str(count.count()) + " out of " + str(len(new_genes)))
+
+        store.flush()
+        os.fsync(store.fileno())
+
+    #the index is replaced once the phenotypes are written, so every gene in the index is always in the file
+    index_file = PHENOTYPE_STORE_INDEX_FILE(dataset, n, seed)
+    pickle.dump((matrix.ids, genes + new_genes), open(index_file + ".tmp", 'wb'), protocol=-1)
+    os.replace(index_file + ".tmp", index_file)
+
+@lru_cache(maxsize=16)
+def load_sim_phenotype_store(dataset, n, master_genes=(), seed=DEFAULT_SEED):
+    '''
+    Returns the simulated phenotypes of the dataset, caching data along the way. The bit-packed replicates are memory
+    mapped rather than read into memory.
+
+    The runner generates its replicates lazily instead (see iterate_sim_phenotypes). The store backs
+    load_sim_phenotypes and load_sim_phenotype_matrix, for callers which need every replicate at once.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param n: the number of simulations to run
+    :type n: int
+
+    :param master_genes: the master genes which should be in the store
+    :type master_genes: tuple
+
+    :param seed: the run seed of the simulations (see random_streams)
+    :type seed: int
+
+    :returns: a data_models.phenotype_store
+    '''
+    if os.path.exists(PHENOTYPE_STORE_INDEX_FILE(dataset, n, seed)):
+        ids, genes = pickle.load(open(PHENOTYPE_STORE_INDEX_FILE(dataset, n, seed), 'rb'))
+        if set(master_genes) <= set(genes) and list(ids) == list(load_expression_matrix(dataset).ids):
+            print("\tOpenning cached simulated phenotype data!")
+            shape = (len(genes), n, (len(ids) + 7) // 8)
+            packed = np.memmap(PHENOTYPE_STORE_FILE(dataset, n, seed), dtype=np.uint8, mode='r', shape=shape) \
+                if genes else np.empty(shape, dtype=np.uint8)
+            return phenotype_store(ids, genes, packed)
+
+    print("\tCalculating simulated phenotype data!")
+    dump_sim_phenotypes(dataset, n, master_genes, seed)
+    print("\tSaving simulated phenotype data!")
+    return load_sim_phenotype_store(dataset, n, master_genes, seed)
+
+from simulation import class1_posterior
+from simulation import generate_phenotypes
+@lru_cache(maxsize=16)
+def load_phenotype_posterior(dataset, master_gene):
+    '''
+    Returns the class 1 probability of every sample of the dataset under the master gene's mixture model, in the
+    order of the dataset's expression matrix. Only kept in memory, as it is cheap to calculate.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
     :param master_gene: the master gene used to simulate data
     :type master_gene: str
     '''
+    matrix = load_expression_matrix(dataset)
+    return class1_posterior(load_gene_models(dataset)[master_gene], matrix.values[matrix.gene_index[master_gene]])
 
-    if not os.path.exists(PHENOTYPE_SIMS_DIR(dataset, n, master_gene)):
-        os.makedirs(PHENOTYPE_SIMS_DIR(dataset, n, master_gene))
+def iterate_sim_phenotypes(dataset, n, master_gene, seed=DEFAULT_SEED):
+    '''
+    Lazily simulates the n phenotypes of the given master gene, rather than loading them from the phenotype store.
+    The replicates are the ones load_sim_phenotype_store holds for the same seed.
 
-    models = load_gene_models(dataset)
-    samples = load_sample_profiles(dataset)
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
 
-    data_sets = []
-    count = counter()
-    for i in range(0, n):
-        labels = simulate_data(models, master_gene, [samples[key] for key in samples.keys()], len(samples))
-        data_sets.append(labels)
-        print("\t\tSimulation " + str(count.count()) + " complete out of " + str(n))
+    :param n: the number of simulations to run
+    :type n: int
+
+    :param master_gene: the master gene used to simulate data
+    :type master_gene: str
+
+    :param seed: the run seed of the simulations (see random_streams)
+    :type seed: int
+
+    :returns: a generator of boolean arrays, True for the class 1 samples of a replicate, with samples in the order of
+              the dataset's expression matrix
+    '''
+    return generate_phenotypes(load_phenotype_posterior(dataset, master_gene), n, master_gene, seed)
 
-    pickle.dump(data_sets, open(PHENOTYPE_SIMS_FILE(dataset, n, master_gene), 'wb'))
+def load_sim_phenotype_matrix(dataset, n, master_gene):
+    '''
+    Returns n simulated phenotypes using the given mastergene as an array, caching data along the way
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param n: the number of simulations to run
+    :type n: int
+
+    :param master_gene: the master gene used to simulate data
+    :type master_gene: str
+
+    :returns: an n x samples uint8 array of classes, with samples in the order of the dataset's expression matrix
+    '''
+    return load_sim_phenotype_store(dataset, n, (master_gene,)).masks(master_gene).astype(np.uint8)
 
 @lru_cache(maxsize=16)
 def load_sim_phenotypes(dataset, n, master_gene):
@@ -530,15 +1070,12 @@ def load_sim_phenotypes(dataset, n, master_gene):
 
     :param master_gene: the master gene used to simulate data
     :type master_gene: str
+
+    :returns: a list of n dicts mapping id's to class (0 or 1)
     '''
-    if os.path.exists(PHENOTYPE_SIMS_FILE(dataset, n, master_gene)):
-        print("\tOpenning cached simulated phenotype data!")
-        return pickle.load(open(PHENOTYPE_SIMS_FILE(dataset, n, master_gene), 'rb'))
+    store = load_sim_phenotype_store(dataset, n, (master_gene,))
 
-    print("\tCalculating simulated phenotype data!")
-    dump_sim_phenotypes(dataset, n, master_gene)
-    print("\tSaving simulated phenotype data!")
-    return load_sim_phenotypes(dataset, n, master_gene)
+    return [dict(zip(store.ids, row.tolist())) for row in store.masks(master_gene).astype(int)]
 
 def load_sim_phenotype_keyed(dataset, n, master_gene):
     '''
@@ -551,147 +1088,760 @@ def load_sim_phenotype_keyed(dataset, n, master_gene):
 '''
 ssGSEA_SCORES_DIR = lambda dataset: DATA_DIR + "/" + dataset + "/"
 
-ssGSEA_SCORES_FILES = lambda dataset, tag: ssGSEA_SCORES_DIR(dataset) + tag + dataset + "_ssGSEAScores.pkl"
-'''Returns the path used to cache/uncache gene enrichment scores per id'''
+ssGSEA_SCORES_FILES = lambda dataset, tag, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED: ssGSEA_SCORES_DIR(dataset) + \
+                                      SEED_TAG(tag, seed) + dataset + "_ssGSEAScores_W_" + str(float(omega)) + ".pkl"
+'''Returns the path used to cache/uncache gene enrichment scores per id for the given weight'''
 from ssGSEA import calculate_enrichment_score
-def dump_ssGSEA_scores(dataset, tag):
+from ssGSEA import calculate_enrichment_score_sweep_from_ranks
+def score_ssGSEA_sets(ranks, omegas, incidence, engine='matrix'):
     """
-    For every id and good gene set of the given dataset, dumps enrichment score information. Specifically dumps
-    a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores for that set. Does not
-    normalize scores, and sets weight value on ranking terms to 0.25
+    Returns the total enrichment score of every sample against every gene set in the given incidence matrix, for
+    every weight on the ranking terms.
+
+    :param ranks: a genes x samples array of ranks starting from 1, see data_models.rank_index
+    :type ranks: numpy.ndarray
+
+    :param omegas: the weights on ranking terms to score with
+    :type omegas: list
+
+    :param incidence: a sets x genes scipy.sparse.csr_matrix with a 1 where a gene is in a set
+    :type incidence: scipy.sparse.csr_matrix
+
+    :param engine: 'matrix' to score all sets and samples in one vectorized pass, or 'loop' to sum the running
+                   scores of calculate_enrichment_score once per set and sample, the original implementation the
+                   matrix engine can be checked against. Both give the same scores.
+    :type engine: str
+
+    :returns: an omegas x samples x sets array of enrichment scores
+    """
+    if engine == 'matrix':
+        weights = np.array([rank_weights(ranks.shape[0], omega) for omega in omegas])
+        return calculate_enrichment_score_sweep_from_ranks(ranks, weights, incidence)
+
+    gene_sets = [set(incidence.indices[incidence.indptr[row]:incidence.indptr[row + 1]].tolist())
+                 for row in range(incidence.shape[0])]
+
+    scores = np.empty((len(omegas), ranks.shape[1], incidence.shape[0]))
+    #go through all the samples, ordering the genes by rank as calculate_enrichment_score orders expressions
+    count = counter()
+    for column in range(ranks.shape[1]):
+        expressions = {gene: -rank for gene, rank in enumerate(ranks[:, column].tolist())}
+
+        #and calculate the ES of every set
+        for row, gene_set in enumerate(gene_sets):
+            for k, omega in enumerate(omegas):
+                scores[k, column, row] = sum(calculate_enrichment_score(gene_set, expressions, omega))
+
+        print("\t\tScores for sample " + str(count.count()) + " done out of " + str(ranks.shape[1]))
+
+    return scores
+
+#the rank matrix each ssGSEA worker process reads from, see _attach_rank_matrix
+_shared_ranks = None
+
+def _attach_rank_matrix(dataset, tag, seed):
+    '''
+    Pool initializer which memory maps the cached rank matrix of the dataset, so every worker reads the same pages
+    rather than receiving its own pickled copy.
+    '''
+    global _shared_ranks
+    _shared_ranks = np.load(RANK_MATRIX_FILE(dataset, tag, seed), mmap_mode='r')
+
+def _score_ssGSEA_shard(omegas, incidence, engine, columns):
+    '''
+    Scores one shard of gene sets against the given columns of the memory mapped rank matrix of the worker
+    '''
+    ranks = _shared_ranks if columns is None else _shared_ranks[:, columns]
+    return score_ssGSEA_sets(ranks, omegas, incidence, engine)
+
+def score_ssGSEA_block(dataset, tag, omegas, incidence, columns=None, engine='matrix', jobs=1, seed=DEFAULT_SEED):
+    """
+    Scores the given gene sets against the samples in the given columns of the dataset's rank index, see
+    score_ssGSEA_sets.
+
+    With more than one job the gene sets are split into one shard per process. Workers memory map the cached rank
+    matrix and the shards are merged back in set order.
+
+    :param incidence: a sets x genes scipy.sparse.csr_matrix of the gene sets to score
+    :type incidence: scipy.sparse.csr_matrix
+
+    :param columns: the columns of the rank index to score, None for every sample
+    :type columns: numpy.ndarray
+
+    :param jobs: the number of processes to score with
+    :type jobs: int
+
+    :param seed: the run seed of the rank index (see load_rank_index)
+    :type seed: int
+
+    :returns: an omegas x samples x sets array of enrichment scores
+    """
+    if jobs > 1:
+        from multiprocessing import Pool
+
+        bounds = np.linspace(0, incidence.shape[0], jobs + 1).astype(int)
+        shards = [incidence[bounds[i]:bounds[i + 1]] for i in range(jobs)]
+
+        with Pool(processes=jobs, initializer=_attach_rank_matrix, initargs=(dataset, tag, seed)) as pool:
+            scores = pool.starmap(_score_ssGSEA_shard, [(omegas, shard, engine, columns) for shard in shards])
+
+        return np.concatenate(scores, axis=2)
+
+    ranks = load_rank_index(dataset, tag, seed).ranks
+    return score_ssGSEA_sets(ranks if columns is None else ranks[:, columns], omegas, incidence, engine)
+
+def calculate_ssGSEA_sweep(dataset, tag, omegas, engine='matrix', jobs=1, seed=DEFAULT_SEED):
+    """
+    For every id and good gene set of the given dataset, returns the enrichment score of every weight in omegas. The
+    samples are ranked once (see load_rank_index) and every weight reuses the same ranks. Does not normalize scores.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param omegas: the weights on ranking terms to score with
+    :type omegas: list
+
+    :param engine: which implementation computes the scores, see score_ssGSEA_sets
+    :type engine: str
+
+    :param jobs: the number of processes to score with, see score_ssGSEA_block
+    :type jobs: int
+
+    :returns: an omegas x samples x sets array of enrichment scores, with samples ordered as the rank index ids and
+              sets as the filtered gene set collection
+    """
+    gene_sets = load_filtered_gene_set_collection(dataset)
+
+    scores = score_ssGSEA_block(dataset, tag, omegas, gene_sets.matrix, None, engine, jobs, seed)
+
+    print("\t\tScores for " + str(len(gene_sets)) + " sets done")
+    return scores
+
+def score_dict(scores, set_names, ids):
+    '''
+    Turns a samples x sets array of scores into a dictionary mapping gene set names to a dictionary mapping id's to
+    the score of that set
+    '''
+    paths = {}
+    for column, set in enumerate(set_names):
+        paths[set] = {id: scores[row, column] for row, id in enumerate(ids)}
+
+    return paths
+
+def calculate_ssGSEA_scores(dataset, tag, engine='matrix', jobs=1, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED):
+    """
+    For every id and good gene set of the given dataset, returns a dictionary mapping gene set names to a dictionary
+    mapping id's to enrichment scores for that set. Does not normalize scores, and sets weight value on ranking terms
+    to 0.25 unless another omega is given. See calculate_ssGSEA_sweep.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :returns: a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores
+    """
+    scores = calculate_ssGSEA_sweep(dataset, tag, [omega], engine, jobs, seed)
+
+    return score_dict(scores[0], load_filtered_gene_set_collection(dataset).set_names,
+                      load_rank_index(dataset, tag, seed).ids)
+
+def dump_ssGSEA_sweep(dataset, tag, omegas, engine='matrix', jobs=1, seed=DEFAULT_SEED):
+    """
+    Brings the score store of every weight in omegas up to date and dumps its scores, each under its own file. The
+    weights which have no store yet are all scored in a single pass (see calculate_ssGSEA_sweep), the others only
+    score their new sets and samples (see update_ssGSEA_scores).
 
     :param dataset: the dataset from which to reference data from
     :type dataset: str
+
+    :param omegas: the weights on ranking terms to score with
+    :type omegas: list
     """
     if not os.path.exists(ssGSEA_SCORES_DIR(dataset)):
         os.makedirs(ssGSEA_SCORES_DIR(dataset))
 
-    gene_sets = load_filtered_gene_sets(dataset)
-    samples = load_sample_profiles(dataset)
+    refresh_ssGSEA_inputs(dataset, tag, seed)
 
-    if tag == 'null':
-        print("Simulating null hypothesis...")
-        scramble_sample(samples)
+    fresh = [omega for omega in omegas if not os.path.exists(ssGSEA_SCORE_STORE_FILE(dataset, tag, omega, seed))]
+    if len(fresh) > 0:
+        scores = calculate_ssGSEA_sweep(dataset, tag, fresh, engine, jobs, seed)
 
-    paths = {}
-    #for each gene set
-    count = counter()
-    for set in gene_sets.keys():
-        gene_set = gene_sets[set].genes
+        gene_sets = load_filtered_gene_set_collection(dataset)
+        index = load_rank_index(dataset, tag, seed)
+        for k, omega in enumerate(fresh):
+            store = score_store(index.genes)
+            store.extend(gene_sets.set_names, index.ids)
+            store.fill(np.arange(len(gene_sets.set_names)), np.arange(len(index.ids)), scores[k].T)
+            _write_ssGSEA_store(store, ssGSEA_SCORE_STORE_FILE(dataset, tag, omega, seed))
 
-        #go through all the samples and calculate the ES
-        scores = {}
-        for id in samples.keys():
-            profile = samples[id].profiles
-            expressions = {}
+    for omega in omegas:
+        dump_ssGSEA_scores(dataset, tag, engine, jobs, omega, seed)
 
-            for gene in profile.keys():
-                expressions[gene] = profile[gene].intensity
+def refresh_ssGSEA_inputs(dataset, tag, seed=DEFAULT_SEED):
+    '''
+    Rebuilds the cached expression matrix, rank index and gene set collection of the dataset which no longer match the
+    data they are built from, so added samples and gene sets reach the enrichment scores without removing any cache
+    by hand. The expression matrix is rebuilt when the sample profiles were dumped after it, the rank index when its
+    id's or genes differ from the matrix, and the collection when its genes differ or the filtered gene sets changed.
 
-            score = calculate_enrichment_score(gene_set, expressions, 0.25)
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
 
-            scores[id] = sum(score)
+    :param seed: the run seed 'null' data is scrambled with (see scramble_matrix)
+    :type seed: int
+    '''
+    if os.path.exists(EXPRESSION_MATRIX_FILE(dataset)) and \
+            is_stale(EXPRESSION_MATRIX_FILE(dataset), [EXPRESSION_PROFILES_FILE(dataset)]):
+        print("\tSample profiles changed, rebuilding expression matrix!")
+        load_sample_profiles.cache_clear()
+        dump_expression_matrix(dataset)
+        load_expression_matrix.cache_clear()
+
+        #the gene statistics are calculated from the matrix, so they are calculated again on next use
+        if os.path.exists(GENE_STATS_FILE(dataset)):
+            os.remove(GENE_STATS_FILE(dataset))
+        load_gene_stats.cache_clear()
+
+    matrix = load_expression_matrix(dataset)
+
+    index = load_rank_index(dataset, tag, seed)
+    if list(index.ids) != list(matrix.ids) or list(index.genes) != list(matrix.genes):
+        print("\tSamples changed, rebuilding rank index!")
+        dump_rank_index(dataset, tag, seed)
+        load_rank_index.cache_clear()
+
+    gene_sets = load_filtered_gene_set_collection(dataset)
+    if list(gene_sets.genes) != list(matrix.genes) or \
+            is_stale(FILTERED_GENE_SET_COLLECTION_FILE(dataset), [FILTERED_GENE_SET_FILE(dataset)]):
+        print("\tGene sets changed, rebuilding gene set collection!")
+        load_filtered_gene_sets.cache_clear()
+        dump_filtered_gene_set_collection(dataset)
+        load_filtered_gene_set_collection.cache_clear()
+
+def _write_ssGSEA_store(store, path):
+    '''
+    Writes a new score store file and swaps it in, so an interrupted write never leaves a broken store
+    '''
+    pickle.dump(store, open(path + ".tmp", 'wb'), protocol=-1)
+    os.replace(path + ".tmp", path)
+
+ssGSEA_SCORE_STORE_FILE = lambda dataset, tag, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED: ssGSEA_SCORES_DIR(dataset) + \
+                                  SEED_TAG(tag, seed) + dataset + "_ssGSEAScoreStore_W_" + str(float(omega)) + ".pkl"
+'''Returns the path used to cache/uncache the incremental score store behind the enrichment scores'''
+def update_ssGSEA_scores(dataset, tag, engine='matrix', jobs=1, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED):
+    """
+    Brings the data_models.score_store of enrichment scores for the dataset up to date with its current filtered gene
+    sets and samples. New gene sets are scored against every sample and new samples against every existing gene set.
+    Cells which were already scored are never recalculated. The whole store is only rescored if the genes of the
+    dataset changed.
 
-        paths[set] = scores
+    The cached expression matrix, rank index and gene set collection are rebuilt first if the samples or gene sets
+    changed, see refresh_ssGSEA_inputs. The store file is only rewritten when something was scored.
 
-        print("\t\tScores for set " + str(count.count()) + " done out of " + str(len(gene_sets.keys())))
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
 
-    pickle.dump(paths, open(ssGSEA_SCORES_FILES(dataset, tag), 'wb'))
+    :returns: the updated data_models.score_store
+    """
+    if not os.path.exists(ssGSEA_SCORES_DIR(dataset)):
+        os.makedirs(ssGSEA_SCORES_DIR(dataset))
+
+    refresh_ssGSEA_inputs(dataset, tag, seed)
+
+    gene_sets = load_filtered_gene_set_collection(dataset)
+    index = load_rank_index(dataset, tag, seed)
+    store_file = ssGSEA_SCORE_STORE_FILE(dataset, tag, omega, seed)
+
+    store = None
+    if os.path.exists(store_file):
+        store = pickle.load(open(store_file, 'rb'))
+        if store.genes != index.genes:
+            print("\tGenes of the dataset changed, rescoring every set!")
+            store = None
+    changed = store is None
+    if store is None:
+        store = score_store(index.genes)
+
+    store.extend(gene_sets.set_names, index.ids)
+
+    rows = np.array([store.set_index[name] for name in gene_sets.set_names], dtype=int)
+    columns = np.array([store.id_index[id] for id in index.ids], dtype=int)
+    missing = ~store.present[np.ix_(rows, columns)]
+
+    #sets without any scores are scored against every sample
+    new_sets = np.flatnonzero(missing.all(axis=1))
+    if len(new_sets) > 0:
+        scores = score_ssGSEA_block(dataset, tag, [omega], gene_sets.matrix[new_sets], None, engine, jobs, seed)[0]
+        store.fill(rows[new_sets], columns, scores.T)
+    print("\t\tScored " + str(len(new_sets)) + " new sets")
+
+    #then samples missing from the remaining sets are scored against those sets
+    missing[new_sets] = False
+    new_ids = np.flatnonzero(missing.any(axis=0))
+    old_sets = np.flatnonzero(missing[:, new_ids].any(axis=1))
+    if len(new_ids) > 0:
+        scores = score_ssGSEA_block(dataset, tag, [omega], gene_sets.matrix[old_sets], new_ids, engine, jobs,
+                                    seed)[0]
+        store.fill(rows[old_sets], columns[new_ids], scores.T)
+    print("\t\tScored " + str(len(new_ids)) + " new samples")
+
+    if changed or len(new_sets) > 0 or len(new_ids) > 0:
+        _write_ssGSEA_store(store, store_file)
+
+    return store
+
+def dump_ssGSEA_scores(dataset, tag, engine='matrix', jobs=1, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED):
+    """
+    For every id and good gene set of the given dataset, dumps enrichment score information. Specifically dumps
+    a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores for that set. Does not
+    normalize scores, and sets weight value on ranking terms to 0.25 unless another omega is given.
+
+    The scores file is a view of the score store, which is brought up to date first so only sets and samples which
+    are not in the store yet are scored, see update_ssGSEA_scores.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param engine: which implementation computes the scores, see score_ssGSEA_sets
+    :type engine: str
+
+    :param jobs: the number of processes to score with
+    :type jobs: int
+
+    :param omega: the weight on ranking terms
+    :type omega: float
+
+    :returns: the dumped dictionary
+    """
+    if not os.path.exists(ssGSEA_SCORES_DIR(dataset)):
+        os.makedirs(ssGSEA_SCORES_DIR(dataset))
+
+    store = update_ssGSEA_scores(dataset, tag, engine, jobs, omega, seed)
+    paths = store.to_dict(load_filtered_gene_set_collection(dataset).set_names, load_rank_index(dataset, tag, seed).ids)
+
+    pickle.dump(paths, open(ssGSEA_SCORES_FILES(dataset, tag, omega, seed), 'wb'))
+    return paths
 
 @lru_cache(maxsize=16)
-def load_ssGSEA_scores(dataset, tag=''):
+def load_ssGSEA_scores(dataset, tag='', jobs=1, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED):
     '''
-    Returns a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores for that set
+    Returns a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores for that set. The
+    score store is always brought up to date first (see update_ssGSEA_scores), and the cached scores file is only
+    opened while it is newer than the store, rank index and gene set collection it is a view of.
 
     :param dataset: the dataset from which to reference data from
     :type dataset: str
 
+    :param jobs: the number of processes to score with if the scores are not cached yet
+    :type jobs: int
+
+    :param omega: the weight on ranking terms
+    :type omega: float
+
+    :param seed: the run seed 'null' data is scrambled with (see scramble_matrix)
+    :type seed: int
+
     :returns: a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores
     '''
+    store = update_ssGSEA_scores(dataset, tag, jobs=jobs, omega=omega, seed=seed)
 
-    if os.path.exists(ssGSEA_SCORES_FILES(dataset, tag)):
+    sources = [ssGSEA_SCORE_STORE_FILE(dataset, tag, omega, seed), RANK_INDEX_FILE(dataset, tag, seed),
+               FILTERED_GENE_SET_COLLECTION_FILE(dataset)]
+    if not is_stale(ssGSEA_SCORES_FILES(dataset, tag, omega, seed), sources):
         print("\tOpenning cached enrichment sets!")
-        return pickle.load(open(ssGSEA_SCORES_FILES(dataset, tag), 'rb'))
+        return pickle.load(open(ssGSEA_SCORES_FILES(dataset, tag, omega, seed), 'rb'))
 
-    print("\tCalculating enrichment data!")
-    dump_ssGSEA_scores(dataset, tag)
     print("\tSaving enrichment data!")
-    return load_ssGSEA_scores(dataset, tag)
+    paths = store.to_dict(load_filtered_gene_set_collection(dataset).set_names, load_rank_index(dataset, tag, seed).ids)
+    pickle.dump(paths, open(ssGSEA_SCORES_FILES(dataset, tag, omega, seed), 'wb'))
+    return paths
+
+def load_ssGSEA_sweep(dataset, omegas, tag='', jobs=1, seed=DEFAULT_SEED):
+    '''
+    Returns a dictionary mapping every weight in omegas to the enrichment scores for that weight (as returned by
+    load_ssGSEA_scores). Weights which are not scored yet are scored together in a single pass.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param omegas: the weights on ranking terms
+    :type omegas: list
+    '''
+    dump_ssGSEA_sweep(dataset, tag, omegas, jobs=jobs, seed=seed)
+
+    return {omega: load_ssGSEA_scores(dataset, tag, jobs, omega, seed) for omega in omegas}
+
+ssGSEA_NES_FILE = lambda dataset, tag, permutations, seed=DEFAULT_SEED: ssGSEA_SCORES_DIR(dataset) + \
+                        SEED_TAG(tag, seed) + dataset + "_ssGSEANormalized_P_" + str(permutations) + "_SEED_" + \
+                        str(seed) + ".pkl"
+'''Returns the path used to cache/uncache normalized enrichment scores and their p-values per id and run seed'''
+from ssGSEA import calculate_normalized_enrichment_scores
+def dump_ssGSEA_nes(dataset, tag, permutations, seed):
+    """
+    For every id and good gene set of the given dataset, dumps normalized enrichment scores and their empirical
+    p-values, found from the given number of random gene sets of every set size. See
+    ssGSEA.calculate_normalized_enrichment_scores. Sets weight value on ranking terms to 0.25
+
+    Dumps a tuple of two dictionaries mapping gene set names to a dictionary mapping id's to the normalized
+    enrichment score and p-value respectively.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param permutations: the number of random gene sets drawn for every set size
+    :type permutations: int
+
+    :param seed: the run seed of the random gene sets, and of the scrambled data for 'null'
+    :type seed: int
+    """
+    if not os.path.exists(ssGSEA_SCORES_DIR(dataset)):
+        os.makedirs(ssGSEA_SCORES_DIR(dataset))
+
+    gene_sets = load_filtered_gene_set_collection(dataset)
+    index = load_rank_index(dataset, tag, seed)
+
+    nes, pvalues = calculate_normalized_enrichment_scores(index.ranks, index.rank_weights(DEFAULT_OMEGA),
+                                                          gene_sets.matrix, permutations, seed)
+
+    paths = (score_dict(nes, gene_sets.set_names, index.ids), score_dict(pvalues, gene_sets.set_names, index.ids))
+    pickle.dump(paths, open(ssGSEA_NES_FILE(dataset, tag, permutations, seed), 'wb'))
+
+@lru_cache(maxsize=16)
+def load_ssGSEA_nes(dataset, tag='', permutations=1000, seed=DEFAULT_SEED):
+    '''
+    Returns the normalized enrichment scores and p-values of the dataset, caching information along the way.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :returns: a tuple (nes, pvalues) of dictionaries mapping gene set names to a dictionary mapping id's to the \
+    normalized enrichment score or p-value
+    '''
+    if os.path.exists(ssGSEA_NES_FILE(dataset, tag, permutations, seed)):
+        print("\tOpenning cached normalized enrichment sets!")
+        return pickle.load(open(ssGSEA_NES_FILE(dataset, tag, permutations, seed), 'rb'))
+
+    print("\tCalculating normalized enrichment data!")
+    dump_ssGSEA_nes(dataset, tag, permutations, seed)
+    print("\tSaving normalized enrichment data!")
+    return load_ssGSEA_nes(dataset, tag, permutations, seed)
+
+ssGSEA_STREAM_FILE = lambda dataset, tag, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED: ssGSEA_SCORES_DIR(dataset) + \
+                                      SEED_TAG(tag, seed) + dataset + "_ssGSEAStream_W_" + str(float(omega)) + ".npy"
+'''Returns the path of the on disk samples x sets score matrix written by dump_ssGSEA_stream'''
+ssGSEA_STREAM_INDEX_FILE = lambda dataset, tag, omega=DEFAULT_OMEGA, seed=DEFAULT_SEED: ssGSEA_SCORES_DIR(dataset) + \
+                                      SEED_TAG(tag, seed) + dataset + "_ssGSEAStream_W_" + str(float(omega)) + ".pkl"
+'''Returns the path of the set names and id's labelling the rows and columns of the streamed score matrix'''
+
+STREAM_BYTES_PER_GENE = 64
+'''Rough working memory used per gene of every sample in a chunk (expressions, ranks, sort order and weights)'''
+STREAM_BYTES_PER_SET = 32
+'''Rough working memory used per gene set of every sample in a chunk (score sums and the scores themselves)'''
+SQLITE_MAX_VARIABLES = 999
+'''The most ? parameters older SQLite builds accept in one statement, which caps the samples queried per chunk'''
+
+def dump_ssGSEA_stream(dataset, tag, omega=DEFAULT_OMEGA, max_memory=2 ** 30, seed=DEFAULT_SEED):
+    """
+    Scores every sample of the dataset against every filtered gene set without ever holding all samples in memory.
+    Samples are read from the expression database a chunk at a time, ranked, scored and appended to a memory mapped
+    samples x sets .npy file. The size of the chunks is chosen so their working memory stays under max_memory.
+    Reports the peak resident memory of the process at the end. Raises a ValueError if a sample has no intensity
+    for one of the genes.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param omega: the weight on ranking terms
+    :type omega: float
+
+    :param max_memory: the memory, in bytes, a chunk of samples may use while being scored
+    :type max_memory: int
+
+    :param seed: the run seed 'null' data is scrambled with. Every sample has its own stream, so the scrambles do
+                 not depend on the chunks (see scramble_matrix).
+    :type seed: int
+    """
+    import resource
+
+    if not os.path.exists(ssGSEA_SCORES_DIR(dataset)):
+        os.makedirs(ssGSEA_SCORES_DIR(dataset))
+
+    cursor = sqlite3.connect(EXPRESSION_PROFILE_DB(dataset)).cursor()
+    table = EXPRESSION_PROFILE_DBTABLE(dataset)
+
+    cursor.execute("Select Distinct Sample From " + table)
+    ids = [row[0] for row in cursor]
+    cursor.execute("Select Distinct Gene From " + table + " WHERE Gene != ''")
+    genes = [row[0] for row in cursor]
+
+    gene_sets = gene_set_collection(filter_gene_sets(load_all_gene_sets(), set(genes)), genes)
+    sample_memory = len(genes) * STREAM_BYTES_PER_GENE + len(gene_sets) * STREAM_BYTES_PER_SET
+    chunk_size = max(1, min(int(max_memory // sample_memory), SQLITE_MAX_VARIABLES))
+    print("\tScoring " + str(len(ids)) + " samples in chunks of " + str(chunk_size))
+
+    #score into a temporary file, so an interrupted run never leaves a partial score matrix behind
+    stream_file = ssGSEA_STREAM_FILE(dataset, tag, omega, seed)
+    scores = np.lib.format.open_memmap(stream_file + ".tmp.npy", mode='w+', shape=(len(ids), len(gene_sets)))
+
+    count = counter()
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        column = {id: i for i, id in enumerate(chunk)}
+
+        values = np.full((len(genes), len(chunk)), np.nan)
+        cursor.execute("Select Sample, Gene, Intensity From " + table + " WHERE Gene != '' AND Sample IN (" +
+                       ",".join("?" * len(chunk)) + ")", chunk)
+        for id, gene, intensity in cursor:
+            values[gene_sets.gene_index[gene], column[id]] = intensity
+
+        #every sample must have every gene, as in the sample profiles the expression matrix is built from
+        missing = np.isnan(values)
+        if missing.any():
+            cursor.close()
+            row, col = np.argwhere(missing)[0]
+            raise ValueError("Sample " + str(chunk[col]) + " has no intensity for gene " + str(genes[row]) + " (" +
+                             str(int(missing.sum())) + " missing values in chunk)")
+
+        matrix = expression_matrix(genes, chunk, values)
+        if tag == 'null':
+            matrix = scramble_matrix(matrix, seed)
+
+        scores[start:start + len(chunk)] = score_ssGSEA_sets(rank_matrix(matrix.values), [omega], gene_sets.matrix)[0]
+        scores.flush()
+        del matrix, values
+
+        print("\t\tScored chunk " + count.count() + " out of " + str((len(ids) + chunk_size - 1) // chunk_size))
+
+    cursor.close()
+    del scores
+
+    #the index is written last, load_ssGSEA_stream only trusts the scores once it exists
+    os.replace(stream_file + ".tmp.npy", stream_file)
+    index_file = ssGSEA_STREAM_INDEX_FILE(dataset, tag, omega, seed)
+    pickle.dump((gene_sets.set_names, ids), open(index_file + ".tmp", 'wb'))
+    os.replace(index_file + ".tmp", index_file)
+
+    #ru_maxrss is in kilobytes on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("\tPeak resident memory: " + str(round(peak / 1024, 1)) + " MB")
+
+def load_ssGSEA_stream(dataset, tag='', omega=DEFAULT_OMEGA, seed=DEFAULT_SEED):
+    '''
+    Returns the streamed enrichment scores of the dataset as a memory mapped array, calculating them along the way.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :returns: a tuple (set_names, ids, scores) where scores is a read only samples x sets numpy.memmap
+    '''
+    if os.path.exists(ssGSEA_STREAM_FILE(dataset, tag, omega, seed)) and \
+            os.path.exists(ssGSEA_STREAM_INDEX_FILE(dataset, tag, omega, seed)):
+        print("\tOpenning streamed enrichment scores!")
+        set_names, ids = pickle.load(open(ssGSEA_STREAM_INDEX_FILE(dataset, tag, omega, seed), 'rb'))
+        return (set_names, ids, np.load(ssGSEA_STREAM_FILE(dataset, tag, omega, seed), mmap_mode='r'))
+
+    print("\tStreaming enrichment data!")
+    dump_ssGSEA_stream(dataset, tag, omega, seed=seed)
+    print("\tSaved enrichment data!")
+    return load_ssGSEA_stream(dataset, tag, omega, seed)
 
 '''
 ****************************Bayes Phenotypes****************************
 '''
 BAYES_SCORES_DIR = lambda dataset: DATA_DIR + "/" + dataset + "/"
-BAYES_SCORES_FILE = lambda dataset, mode, tag: BAYES_SCORES_DIR(dataset) + tag + dataset + "_" + str(mode) + "_BayesHighScores.pkl"
+BAYES_SCORES_FILE = lambda dataset, mode, tag, per_gene=False, tabulated=False, seed=DEFAULT_SEED: \
+    BAYES_SCORES_DIR(dataset) + SEED_TAG(tag, seed) + dataset + "_" + str(mode) + \
+    ("_Tabulated" if tabulated else "") + ("_BayesGeneScores.pkl" if per_gene else "_BayesHighScores.pkl")
 '''Returns the path used to cache/uncache gene enrichment scores per id'''
-from p_model import pmodel
-def dump_bayes_scores(dataset, mode, tag):
+from p_model import MODES
+from p_model import pmodel_matrix
+from p_model import fit_gene_distributions
+
+def normalized_expression_matrix(dataset, tag, seed=DEFAULT_SEED):
+    '''
+    Returns the expression matrix of the dataset, scrambled for 'null', together with its expression data
+    transformed into values between 0 and 1 (see normalize_expressions), one row per gene and one column per sample.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+
+    :param tag: 'null' to scramble the expression data, '' otherwise
+    :type tag: str
+
+    :param seed: the run seed 'null' data is scrambled with (see scramble_matrix)
+    :type seed: int
+
+    :returns: a tuple (matrix, values)
+    '''
+    matrix = load_expression_matrix(dataset)
+
+    if tag == 'null':
+        print("Simulating null hypothesis...")
+        matrix = scramble_matrix(matrix, seed)
+        stats = calculate_gene_stats(matrix.values)
+    else:
+        stats = load_gene_stats(dataset)
+
+    return matrix, normalize_expressions(matrix.values, stats)
+
+GENE_DISTRIBUTIONS_FILE = lambda dataset, tag='', seed=DEFAULT_SEED: BAYES_SCORES_DIR(dataset) + SEED_TAG(tag, seed) + \
+                                                                    dataset + "_GeneDistributions.npy"
+'''Returns the path used to cache/uncache the per gene low/mid/high distributions, in expression matrix gene order'''
+def dump_gene_distributions(dataset, jobs=1, batch_size=2000, tag='', seed=DEFAULT_SEED):
+    '''
+    Fits a low, mid and high beta distribution to the normalized expression of every gene of the dataset (see
+    p_model.fit_gene_distributions) and dumps their parameters as a genes x 3 x 2 array, with genes in the order of
+    the dataset's expression matrix. Genes are fitted in batches spread over a pool of processes.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+
+    :param jobs: the number of processes to fit with
+    :type jobs: int
+
+    :param batch_size: the number of genes fitted together by one process at a time
+    :type batch_size: int
+
+    :param tag: 'null' to fit the scrambled expression data the null scores are calculated from, '' otherwise
+    :type tag: str
+
+    :param seed: the run seed 'null' data is scrambled with (see scramble_matrix)
+    :type seed: int
+    '''
+    if not os.path.exists(BAYES_SCORES_DIR(dataset)):
+        os.makedirs(BAYES_SCORES_DIR(dataset))
+
+    values = normalized_expression_matrix(dataset, tag, seed)[1]
+
+    batches = [values[start:start + batch_size] for start in range(0, len(values), batch_size)]
+    print("\t\tFitting " + str(len(values)) + " genes in " + str(len(batches)) + " batches")
+
+    if jobs > 1:
+        from multiprocessing import Pool
+
+        with Pool(processes=jobs) as pool:
+            distributions = pool.map(fit_gene_distributions, batches)
+    else:
+        distributions = [fit_gene_distributions(batch) for batch in batches]
+
+    np.save(GENE_DISTRIBUTIONS_FILE(dataset, tag, seed), np.concatenate(distributions))
+
+@lru_cache(maxsize=16)
+def load_gene_distributions(dataset, jobs=1, tag='', seed=DEFAULT_SEED):
+    '''
+    Returns the per gene low/mid/high distributions of the dataset, caching information along the way.
+
+    :param dataset: the name of the dataset downloading data from
+    :type dataset: str
+
+    :returns: a genes x 3 x 2 array of beta parameters, with genes in the order of the dataset's expression matrix
+    '''
+    if os.path.exists(GENE_DISTRIBUTIONS_FILE(dataset, tag, seed)):
+        print("\tOpenning cached gene distributions!")
+        return np.load(GENE_DISTRIBUTIONS_FILE(dataset, tag, seed))
+
+    print("\tFitting gene distributions!")
+    dump_gene_distributions(dataset, jobs, tag=tag, seed=seed)
+    print("\tSaved gene distributions!")
+    return load_gene_distributions(dataset, jobs, tag, seed)
+
+BAYES_SCORE_ARRAY_FILE = lambda dataset, tag, per_gene=False, tabulated=False, seed=DEFAULT_SEED: \
+    BAYES_SCORES_DIR(dataset) + SEED_TAG(tag, seed) + dataset + ("_Tabulated" if tabulated else "") + \
+    ("_BayesGeneModeScores.pkl" if per_gene else "_BayesModeScores.pkl")
+'''Returns the path used to cache/uncache the probabilities of every mode together'''
+def dump_bayes_score_array(dataset, tag, per_gene=False, tabulated=False, jobs=1, seed=DEFAULT_SEED):
     """
-    For every id and good gene set of the given dataset, dumps enrichment score information. Specifically dumps
-    a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores for that set.
+    For every id and good gene set of the given dataset, calculates the probability of low, mid and high expression
+    in a single pass and dumps them together as a tuple (set_names, ids, scores) where scores is a 3 x samples x sets
+    array ordered as p_model.MODES.
 
     :param dataset: the dataset from which to reference data from
     :type dataset: str
+
+    :param per_gene: True to score with distributions fitted to every gene (see load_gene_distributions) rather than
+                     the shared ones
+    :type per_gene: bool
+
+    :param tabulated: True to look the likelihoods of the shared distributions up in precomputed tables (see
+                      p_model.beta_table) rather than evaluating them with scipy. Ignored when per_gene is True.
+    :type tabulated: bool
+
+    :param jobs: the number of processes used to fit the per gene distributions if they are not cached yet
+    :type jobs: int
+
+    :param seed: the run seed 'null' data is scrambled with (see scramble_matrix)
+    :type seed: int
     """
     if not os.path.exists(BAYES_SCORES_DIR(dataset)):
         os.makedirs(BAYES_SCORES_DIR(dataset))
 
     gene_sets = load_filtered_gene_sets(dataset)
-    samples = load_sample_profiles(dataset)
+    matrix, values = normalized_expression_matrix(dataset, tag, seed)
 
-    if tag == 'null':
-        print("Simulating null hypothesis...")
-        scramble_sample(samples)
+    set_names = [set for set in gene_sets.keys()]
+    ids = matrix.ids
+    scores = np.empty((len(MODES), len(ids), len(set_names)))
+    #for 'null' the distributions are fitted to the same scrambled values they score
+    distributions = load_gene_distributions(dataset, jobs, tag, seed) if per_gene else None
 
-    max_expression = {}
-    min_negative_expression = {}
-    #first normalize gene expression value
-    for id in samples:
-        sample = samples[id]
-        for gene in sample.profiles.keys():
-            exp = sample.profiles[gene].intensity
-
-            if gene not in max_expression.keys():
-                max_expression[gene] = exp
-            if exp > max_expression[gene]:
-                max_expression[gene] = exp
-
-            if gene not in min_negative_expression.keys():
-                min_negative_expression[gene] = 0
-            if exp < min_negative_expression[gene]:
-                min_negative_expression[gene] = exp
-                
-    paths = {}
     #for each gene set
     count = counter()
-    for set in gene_sets.keys():
-        gene_set = gene_sets[set].genes
+    for column, set in enumerate(set_names):
+        gene_ids = [matrix.gene_index[gene] for gene in gene_sets[set].genes]
+        expressions = values[gene_ids].T
+
+        #then score the set for every sample and mode at once
+        probabilities = pmodel_matrix(expressions, [1/3 , 1/3, 1/3], tabulated, distributions=distributions,
+                                      gene_ids=gene_ids if per_gene else None)
+        for row in np.flatnonzero(np.isnan(probabilities).any(axis=1)):
+            print(expressions[row])
+
+        scores[:, :, column] = probabilities.T
+
+        print("\t\tScores for set " + str(count.count()) + " done out of " + str(len(set_names)))
+
+    pickle.dump((set_names, ids, scores), open(BAYES_SCORE_ARRAY_FILE(dataset, tag, per_gene, tabulated, seed), 'wb'),
+                protocol=-1)
+
+@lru_cache(maxsize=16)
+def load_bayes_score_array(dataset, tag='', per_gene=False, tabulated=False, jobs=1, seed=DEFAULT_SEED):
+    '''
+    Returns the probabilities of every mode for every gene set and id, caching information along the way.
+
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
 
-        #go through all the samples and calculate the ES
-        scores = {}
-        for id in samples.keys():
-            profile = samples[id].profiles
-            expressions = []
+    :returns: a tuple (set_names, ids, scores) where scores is a 3 x samples x sets array ordered as p_model.MODES
+    '''
+    if os.path.exists(BAYES_SCORE_ARRAY_FILE(dataset, tag, per_gene, tabulated, seed)):
+        print("\tOpenning cached bayes scores!")
+        return pickle.load(open(BAYES_SCORE_ARRAY_FILE(dataset, tag, per_gene, tabulated, seed), 'rb'))
 
-            for gene in profile.keys():
-                if gene in gene_set:
-                    #transform expression data into values between 0 and 1
-                    #-.0001 because rounding to 1 = nan values
-                    expressions.append((profile[gene].intensity - min_negative_expression[gene]) / (max_expression[gene] - min_negative_expression[gene]))
+    print("\tCalculating bayes scores for every mode!")
+    dump_bayes_score_array(dataset, tag, per_gene, tabulated, jobs, seed)
+    print("\tSaving bayes scores!")
+    return load_bayes_score_array(dataset, tag, per_gene, tabulated, jobs, seed)
 
-            score = pmodel(expressions, [1/3 , 1/3, 1/3], mode)
-            if str(score) == 'nan':
-                print(expressions)
-            scores[id] = score
+def dump_bayes_scores(dataset, mode, tag, per_gene=False, tabulated=False, jobs=1, seed=DEFAULT_SEED):
+    """
+    For every id and good gene set of the given dataset, dumps enrichment score information. Specifically dumps
+    a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores for that set. The scores
+    are taken from the scores of every mode, so once one mode is calculated the others come free.
 
-        paths[set] = scores
+    :param dataset: the dataset from which to reference data from
+    :type dataset: str
+    """
+    if not os.path.exists(BAYES_SCORES_DIR(dataset)):
+        os.makedirs(BAYES_SCORES_DIR(dataset))
 
-        print("\t\tScores for set " + str(count.count()) + " done out of " + str(len(gene_sets.keys())))
+    set_names, ids, scores = load_bayes_score_array(dataset, tag, per_gene, tabulated, jobs, seed)
+    mode_index = MODES.index(mode) if mode in MODES else MODES.index('mid')
 
-    pickle.dump(paths, open(BAYES_SCORES_FILE(dataset, mode, tag), 'wb'))
+    paths = score_dict(scores[mode_index], set_names, ids)
+
+    pickle.dump(paths, open(BAYES_SCORES_FILE(dataset, mode, tag, per_gene, tabulated, seed), 'wb'))
 
 @lru_cache(maxsize=16)
-def load_bayes_scores(dataset, mode, tag=''):
+def load_bayes_scores(dataset, mode, tag='', per_gene=False, tabulated=False, jobs=1, seed=DEFAULT_SEED):
     '''
     Returns a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores for that set
 
@@ -701,23 +1851,25 @@ def load_bayes_scores(dataset, mode, tag=''):
     :returns: a dictionary mapping gene set names to a dictionary mapping id's to enrichment scores
     '''
 
-    if os.path.exists(BAYES_SCORES_FILE(dataset, mode, tag)):
+    if os.path.exists(BAYES_SCORES_FILE(dataset, mode, tag, per_gene, tabulated, seed)):
         print("\tOpenning cached enrichment sets!")
-        return pickle.load(open(BAYES_SCORES_FILE(dataset, mode, tag), 'rb'))
+        return pickle.load(open(BAYES_SCORES_FILE(dataset, mode, tag, per_gene, tabulated, seed), 'rb'))
 
     print("\tCalculating enrichment data!")
-    dump_bayes_scores(dataset, mode, tag)
+    dump_bayes_scores(dataset, mode, tag, per_gene, tabulated, jobs, seed)
     print("\tSaving enrichment data!")
-    return load_bayes_scores(dataset, mode, tag)
+    return load_bayes_scores(dataset, mode, tag, per_gene, tabulated, jobs, seed)
 
 '''
 Null enrichment
 '''
 NULL_SCORES_DIR = lambda dataset: DATA_DIR + "/" + dataset + "/"
-NULL_SCORES_FILE = lambda dataset, tag: NULL_SCORES_DIR(dataset) + tag + dataset + "_"  + "_NullHighScores.pkl"
-def dump_null_scores(dataset, tag):
+NULL_SCORES_FILE = lambda dataset, tag, seed=DEFAULT_SEED: NULL_SCORES_DIR(dataset) + tag + dataset + "_SEED_" + \
+                                                           str(seed) + "_NullHighScores.pkl"
+def dump_null_scores(dataset, tag, seed=DEFAULT_SEED):
     '''
     Dumps a dictionary mapping gene set to a dicitonary mapping id's to enrichment scores for that set (random scorse)
+    drawn from the streams of the given run seed (see random_streams)
     '''
     if not os.path.exists(NULL_SCORES_DIR(dataset)):
         os.makedirs(NULL_SCORES_DIR(dataset))
@@ -727,45 +1879,56 @@ def dump_null_scores(dataset, tag):
 
     if tag == 'null':
         print("Simulating null hypothesis")
-        scramble_sample(samples)
+        scramble_sample(samples, seed)
 
     random_scores = {}
+    ids = [id for id in samples.keys()]
     for set in gene_sets.keys():
-        local_scores = {}
-        for id in samples.keys():
-            import random
-            local_scores[id] = random.random() * 5000
-
-        random_scores[set] = local_scores
+        #every set draws from its own stream, see random_streams
+        draws = generator('null', set, 0, seed).random(len(ids)) * 5000
+        random_scores[set] = dict(zip(ids, draws.tolist()))
 
-    pickle.dump(random_scores, open(NULL_SCORES_FILE(dataset, tag), 'wb'))
+    pickle.dump(random_scores, open(NULL_SCORES_FILE(dataset, tag, seed), 'wb'))
 
 @lru_cache(maxsize=16)
-def load_null_scores(dataset, tag=''):
-    if os.path.exists(NULL_SCORES_FILE(dataset, tag)):
+def load_null_scores(dataset, tag='', seed=DEFAULT_SEED):
+    if os.path.exists(NULL_SCORES_FILE(dataset, tag, seed)):
         print("\tOpenning cached enrichment sets!")
-        return pickle.load(open(NULL_SCORES_FILE(dataset, tag), 'rb'))
+        return pickle.load(open(NULL_SCORES_FILE(dataset, tag, seed), 'rb'))
 
     print("\tCalculating enrichment data!")
-    dump_null_scores(dataset, tag)
+    dump_null_scores(dataset, tag, seed)
     print("\tSaving enrichment data!")
-    return load_null_scores(dataset, tag)
+    return load_null_scores(dataset, tag, seed)
 
 '''
 For null tests given a map of ids to sample_profile objects, will scramble the gene labels for expression levels
 '''
-def scramble_sample(samples):
-    import random
+def scramble_sample(samples, seed=DEFAULT_SEED):
     for id in samples:
         print("\tScrambling sample id", id)
         sample = samples[id]
         profiles = sample.profiles
 
+        #every sample is shuffled by the stream of its id, see random_streams
         profile_scores = [profiles[gene].intensity for gene in profiles]
-        random.shuffle(profile_scores)
+        order = generator('scramble', id, 0, seed).permutation(len(profile_scores))
+
+        for gene, i in zip(profiles, order):
+            profiles[gene].intensity = profile_scores[i]
+
+def scramble_matrix(matrix, seed=DEFAULT_SEED):
+    '''
+    As scramble_sample, but for a data_models.expression_matrix. Shuffles the expression levels within every sample
+    column of a copy of the matrix, leaving the given matrix untouched. Draws the same shuffles as scramble_sample.
+    Shuffles are keyed by sample id, so a sample is scrambled the same way whichever columns it is scrambled with.
+    '''
+    values = matrix.values.copy()
+    for column, id in enumerate(matrix.ids):
+        print("\tScrambling sample id", id)
+        values[:, column] = values[generator('scramble', id, 0, seed).permutation(len(values)), column]
 
-        for gene in profiles:
-            profiles[gene].intensity = profile_scores.pop()
+    return expression_matrix(matrix.genes, matrix.ids, values)
 
 if __name__ == "__main__":
     g = load_sample_profiles("BC")
@@ -2,6 +2,9 @@
 This file contains the models used for structuring how gene expression data is stored
 '''
 
+import numpy as np
+from scipy.sparse import csr_matrix
+
 class expression_profile:
     """
     Represents a single expression value of a single gene from a single sample.
@@ -73,4 +76,471 @@ class sample:
     """
     def __init__(self, profiles, id):
         self.profiles = profiles
-        self.id = id
\ No newline at end of file
+        self.id = id
+
+class expression_matrix:
+    """
+    A dense view of a dataset's expression data, with one row per gene and one column per sample. This is the
+    layout the vectorized scoring methods work on.
+
+    :param genes: the gene names, in the order of the rows of values
+    :type genes: list
+
+    :param ids: the sample id's, in the order of the columns of values
+    :type ids: list
+
+    :param values: a genes x samples array of expression intensities
+    :type values: numpy.ndarray
+    """
+    def __init__(self, genes, ids, values):
+        self.genes = genes
+        self.ids = ids
+        self.values = values
+        self.gene_index = {gene: i for i, gene in enumerate(genes)}
+
+class rank_index:
+    """
+    The rank of every gene within every sample of a dataset, computed once and shared by all rank based scoring
+    methods. Rank 1 is the highest expressed gene of a sample.
+
+    :param genes: the gene names, in the order of the rows of ranks
+    :type genes: list
+
+    :param ids: the sample id's, in the order of the columns of ranks
+    :type ids: list
+
+    :param ranks: a genes x samples array of ranks stored as uint16, or uint32 for more than 65535 genes
+    :type ranks: numpy.ndarray
+
+    :param omega: the exponent the stored weights were calculated with
+    :type omega: float
+    """
+    def __init__(self, genes, ids, ranks, omega):
+        self.genes = genes
+        self.ids = ids
+        self.ranks = ranks
+        self.omega = omega
+        self.weights = rank_weights(len(genes), omega)
+        self.gene_index = {gene: i for i, gene in enumerate(genes)}
+        self.id_index = {id: i for i, id in enumerate(ids)}
+
+    def sample_ranks(self, id):
+        """
+        Returns the ranks of the genes of one sample as a mapping of gene names to ranks, looking each gene up in the
+        rank matrix only when asked for.
+
+        :param id: the sample id
+        :type id: int
+
+        :returns: a sample_ranks
+        """
+        return sample_ranks(self, self.id_index[id])
+
+    def rank_weights(self, omega):
+        """
+        Returns the weights :math:`i^{omega}` of the ranks 1 to the number of genes, reusing the stored weights when
+        omega matches.
+
+        :param omega: the weighted exponent on the ranks
+        :type omega: float
+
+        :returns: an array where entry i - 1 is the weight of rank i
+        """
+        if omega == self.omega:
+            return self.weights
+        return rank_weights(len(self.genes), omega)
+
+class sample_ranks:
+    """
+    The ranks of every gene of one sample of a rank_index, indexed by gene name.
+
+    :param index: the rank index of the dataset
+    :type index: rank_index
+
+    :param column: the column of the sample in the rank matrix
+    :type column: int
+    """
+    def __init__(self, index, column):
+        self.index = index
+        self.column = column
+
+    def __getitem__(self, gene):
+        return int(self.index.ranks[self.index.gene_index[gene], self.column])
+
+    def __len__(self):
+        return len(self.index.genes)
+
+def rank_weights(n, omega):
+    """
+    Returns the weights :math:`i^{omega}` for the ranks 1 to n as an array where entry i - 1 is the weight of rank i
+    """
+    return np.arange(1, n + 1, dtype=np.float64) ** omega
+
+class gene_set_collection:
+    """
+    A collection of gene sets held as a sets x genes sparse incidence matrix, where genes are referred to by integer
+    id's rather than names. Membership checks and matrix products against expression or rank matrices replace looping
+    over the genes of gene_set objects.
+
+    :param gene_sets: a map of gene_set names to gene_set objects
+    :type gene_sets: dict
+
+    :param genes: the gene names of the columns of the matrix, usually the rows of the dataset's expression_matrix.
+                  Every gene of every gene set should be in this list.
+    :type genes: list
+    """
+    def __init__(self, gene_sets, genes):
+        self.set_names = [name for name in gene_sets.keys()]
+        self.urls = [gene_sets[name].url for name in self.set_names]
+        self.genes = genes
+
+        self.set_index = {name: i for i, name in enumerate(self.set_names)}
+        self.gene_index = {gene: i for i, gene in enumerate(genes)}
+
+        rows = []
+        cols = []
+        for row, name in enumerate(self.set_names):
+            members = sorted(self.gene_index[gene] for gene in gene_sets[name].genes)
+            rows += [row] * len(members)
+            cols += members
+
+        self.matrix = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(self.set_names), len(genes)))
+        self.matrix.sort_indices()
+
+    def __len__(self):
+        return len(self.set_names)
+
+    def sizes(self):
+        """
+        Returns an array with the number of genes in every set, in set order
+        """
+        return np.diff(self.matrix.indptr)
+
+    def member_ids(self, set_name):
+        """
+        Returns the sorted integer id's of the genes in the given set
+        """
+        row = self.set_index[set_name]
+        return self.matrix.indices[self.matrix.indptr[row]:self.matrix.indptr[row + 1]]
+
+    def members(self, set_name):
+        """
+        Returns the names of the genes in the given set
+        """
+        return [self.genes[i] for i in self.member_ids(set_name)]
+
+    def contains(self, set_name, gene):
+        """
+        Returns True if the given gene is in the given set
+        """
+        if gene not in self.gene_index:
+            return False
+        ids = self.member_ids(set_name)
+        i = np.searchsorted(ids, self.gene_index[gene])
+        return bool(i < len(ids) and ids[i] == self.gene_index[gene])
+
+    def popularity(self):
+        """
+        Returns an array with the number of sets every gene appears in, in gene order
+        """
+        return np.bincount(self.matrix.indices, minlength=len(self.genes))
+
+    def sets_containing(self, gene):
+        """
+        Returns the names of the sets which contain the given gene
+        """
+        if gene not in self.gene_index:
+            return []
+        column = self.matrix[:, self.gene_index[gene]]
+        return [self.set_names[i] for i in column.nonzero()[0]]
+
+class gene_set_index:
+    """
+    An inverted index of a gene_set_collection, mapping every gene to the sets containing it. The index is a genes x
+    sets sparse incidence matrix, so the sets of a gene are one contiguous slice of sorted set id's.
+
+    :param collection: the gene sets to index
+    :type collection: gene_set_collection
+    """
+    def __init__(self, collection):
+        self.set_names = collection.set_names
+        self.genes = collection.genes
+        self.gene_index = collection.gene_index
+
+        self.matrix = collection.matrix.T.tocsr()
+        self.matrix.sort_indices()
+
+    def set_ids(self, gene):
+        """
+        Returns the sorted integer id's of the sets which contain the given gene
+        """
+        if gene not in self.gene_index:
+            return self.matrix.indices[:0]
+        row = self.gene_index[gene]
+        return self.matrix.indices[self.matrix.indptr[row]:self.matrix.indptr[row + 1]]
+
+    def sets_containing(self, gene):
+        """
+        Returns the names of the sets which contain the given gene
+        """
+        return [self.set_names[i] for i in self.set_ids(gene)]
+
+    def popularity(self, gene):
+        """
+        Returns the number of sets the given gene appears in
+        """
+        if gene not in self.gene_index:
+            return 0
+        row = self.gene_index[gene]
+        return int(self.matrix.indptr[row + 1] - self.matrix.indptr[row])
+
+    def popularities(self):
+        """
+        Returns an array with the number of sets every gene appears in, in gene order
+        """
+        return np.diff(self.matrix.indptr)
+
+    def overlap(self, gene_a, gene_b):
+        """
+        Returns the names of the sets which contain both given genes
+        """
+        shared = np.intersect1d(self.set_ids(gene_a), self.set_ids(gene_b), assume_unique=True)
+        return [self.set_names[i] for i in shared]
+
+class score_store:
+    """
+    A sets x samples table of scores which can grow as gene sets and samples are added. Every cell records whether it
+    has been scored, so only the missing cells ever need to be calculated.
+
+    :param genes: the genes the scores were calculated over. Scores are only comparable while these stay the same.
+    :type genes: list
+    """
+    def __init__(self, genes):
+        self.genes = genes
+        self.set_names = []
+        self.ids = []
+        self.scores = np.empty((0, 0))
+        self.present = np.zeros((0, 0), dtype=bool)
+        self.set_index = {}
+        self.id_index = {}
+
+    def extend(self, set_names, ids):
+        """
+        Adds rows for any of the given sets and columns for any of the given id's which are not yet in the store. The
+        new cells are marked as not scored.
+
+        :param set_names: the names of the gene sets which should be in the store
+        :type set_names: list
+
+        :param ids: the sample id's which should be in the store
+        :type ids: list
+        """
+        new_sets = [name for name in set_names if name not in self.set_index]
+        new_ids = [id for id in ids if id not in self.id_index]
+
+        for name in new_sets:
+            self.set_index[name] = len(self.set_names)
+            self.set_names.append(name)
+        for id in new_ids:
+            self.id_index[id] = len(self.ids)
+            self.ids.append(id)
+
+        scores = np.full((len(self.set_names), len(self.ids)), np.nan)
+        present = np.zeros((len(self.set_names), len(self.ids)), dtype=bool)
+        scores[:self.scores.shape[0], :self.scores.shape[1]] = self.scores
+        present[:self.present.shape[0], :self.present.shape[1]] = self.present
+
+        self.scores = scores
+        self.present = present
+
+    def fill(self, rows, columns, scores):
+        """
+        Writes a block of scores into the cells which have not been scored yet, leaving scored cells untouched.
+
+        :param rows: the store rows of the block
+        :type rows: numpy.ndarray
+
+        :param columns: the store columns of the block
+        :type columns: numpy.ndarray
+
+        :param scores: a len(rows) x len(columns) array of scores
+        :type scores: numpy.ndarray
+        """
+        block = np.ix_(rows, columns)
+        missing = ~self.present[block]
+
+        self.scores[block] = np.where(missing, scores, self.scores[block])
+        self.present[block] = True
+
+    def to_dict(self, set_names, ids):
+        """
+        Returns a dictionary mapping the given gene set names to a dictionary mapping the given id's to their scores
+
+        :requires: every cell of the given sets and id's has been scored
+        """
+        paths = {}
+        for name in set_names:
+            row = self.set_index[name]
+            paths[name] = {id: self.scores[row, self.id_index[id]] for id in ids}
+
+        return paths
+
+class gene_mixture:
+    """
+    A two component gaussian mixture model fitted to the expression of a single gene. Exposes the same fitted
+    attributes as a sklearn.mixture.GMM with diagonal covariances, so it can be used wherever a GMM was.
+
+    :param weights: the mixing proportions of the two components
+    :type weights: numpy.ndarray
+
+    :param means: the means of the two components
+    :type means: numpy.ndarray
+
+    :param variances: the variances of the two components
+    :type variances: numpy.ndarray
+
+    :param converged: whether the fit converged before running out of iterations
+    :type converged: bool
+    """
+    def __init__(self, weights, means, variances, converged=True):
+        self.weights_ = np.asarray(weights, dtype=float)
+        self.means_ = np.asarray(means, dtype=float).reshape(2, 1)
+        self.covars_ = np.asarray(variances, dtype=float).reshape(2, 1)
+        self.converged_ = converged
+
+    def sample(self, n_samples=1, random_state=None):
+        """
+        Draws samples from the mixture.
+
+        :param n_samples: the number of samples to draw
+        :type n_samples: int
+
+        :param random_state: a numpy.random.RandomState to draw with, the global one if None
+        :type random_state: numpy.random.RandomState
+
+        :returns: a n_samples x 1 array of samples
+        """
+        random_state = np.random if random_state is None else random_state
+        components = (random_state.random_sample(n_samples) >= self.weights_[0]).astype(int)
+        samples = random_state.standard_normal(n_samples) * self.covars_[components, 0] ** 0.5
+
+        return (samples + self.means_[components, 0])[:, np.newaxis]
+
+class gene_model_table:
+    """
+    The two component gaussian mixture models of many genes, held as one row per gene of numpy arrays rather than
+    as separate model objects. Indexing the table by gene name returns that gene's gene_mixture, so it can be used
+    wherever a dict of gene names to models was.
+
+    :param genes: the names of the genes, in row order
+    :type genes: list
+
+    :param weights: a genes x 2 array of mixing proportions
+    :type weights: numpy.ndarray
+
+    :param means: a genes x 2 array of component means
+    :type means: numpy.ndarray
+
+    :param variances: a genes x 2 array of component variances
+    :type variances: numpy.ndarray
+
+    :param log_likelihood: the mean log likelihood of every gene's samples under its model
+    :type log_likelihood: numpy.ndarray
+
+    :param converged: whether the fit of every gene converged
+    :type converged: numpy.ndarray
+    """
+    def __init__(self, genes, weights, means, variances, log_likelihood, converged):
+        self.genes = list(genes)
+        self.weights = weights
+        self.means = means
+        self.variances = variances
+        self.log_likelihood = log_likelihood
+        self.converged = converged
+        self.gene_index = {gene: i for i, gene in enumerate(self.genes)}
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __iter__(self):
+        return iter(self.genes)
+
+    def __contains__(self, gene):
+        return gene in self.gene_index
+
+    def __getitem__(self, gene):
+        row = self.gene_index[gene]
+        return gene_mixture(self.weights[row], self.means[row], self.variances[row], bool(self.converged[row]))
+
+    def keys(self):
+        return self.genes
+
+    def records(self):
+        """
+        Returns the table as a structured array with one record per gene, which can be saved as a flat binary file
+        and memory mapped back.
+        """
+        records = np.empty(len(self.genes), dtype=[('gene', 'U' + str(max([len(gene) for gene in self.genes] + [1]))),
+                                                   ('weights', 'f8', (2,)), ('means', 'f8', (2,)),
+                                                   ('variances', 'f8', (2,)), ('log_likelihood', 'f8'),
+                                                   ('converged', '?')])
+        records['gene'] = self.genes
+        records['weights'] = self.weights
+        records['means'] = self.means
+        records['variances'] = self.variances
+        records['log_likelihood'] = self.log_likelihood
+        records['converged'] = self.converged
+        return records
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Returns the table held by a structured array made by records. The parameter arrays are views of the given
+        records, so a memory mapped file stays memory mapped.
+        """
+        return cls(records['gene'].tolist(), records['weights'], records['means'], records['variances'],
+                   records['log_likelihood'], records['converged'])
+
+class phenotype_store:
+    """
+    The simulated phenotype replicates of many master genes, stored as bits. Every replicate is one row of bit-packed
+    uint8's over a shared sample index, so class 1 samples are set bits.
+
+    :param ids: the sample id's, in the order of the bits of every replicate
+    :type ids: list
+
+    :param genes: the master genes, in the order of the first axis of packed
+    :type genes: list
+
+    :param packed: a genes x replicates x ceil(samples / 8) uint8 array, as made by pack
+    :type packed: numpy.ndarray
+    """
+    def __init__(self, ids, genes, packed):
+        self.ids = list(ids)
+        self.genes = list(genes)
+        self.packed = packed
+        self.id_index = {id: i for i, id in enumerate(self.ids)}
+        self.gene_index = {gene: i for i, gene in enumerate(self.genes)}
+
+    def __contains__(self, gene):
+        return gene in self.gene_index
+
+    @staticmethod
+    def pack(labels):
+        """
+        Packs a replicates x samples array of 0/1 classes into replicates x ceil(samples / 8) uint8's
+        """
+        return np.packbits(np.asarray(labels, dtype=bool), axis=-1)
+
+    def masks(self, gene):
+        """
+        Returns a replicates x samples boolean array, True for the class 1 samples of every replicate of the given
+        master gene
+        """
+        return np.unpackbits(self.packed[self.gene_index[gene]], axis=-1, count=len(self.ids)).astype(bool)
+
+    def mask(self, gene, replicate):
+        """
+        Returns a boolean array, True for the class 1 samples of one replicate of the given master gene
+        """
+        return np.unpackbits(self.packed[self.gene_index[gene], replicate], count=len(self.ids)).astype(bool)
@@ -3,8 +3,11 @@ This file contains a series of scripts for evaluating gene models and determinin
 a "master gene."
 '''
 import math
+import numpy as np
 
 from scipy.stats import norm
+from data_models import gene_set_collection
+from data_models import gene_set_index
 
 def calculate_prior(model):
     """
@@ -13,7 +16,7 @@ def calculate_prior(model):
     :requires: the model is composed of two gaussian components!
 
     :param model: the mixture model of a given gene
-    :type model: sklearn.mixture.GMM
+    :type model: data_models.gene_mixture
 
     :returns: float representing the calculated prior of this model
     """
@@ -117,7 +120,7 @@ def calculate_bayes_error(model):
     :requires: the model is composed of two gaussian components!
 
     :param model: the mixture model of a given gene
-    :type model: sklearn.mixture.GMM
+    :type model: data_models.gene_mixture
 
     :returns: the bayes error of the classifier as a float
     """
@@ -152,12 +155,19 @@ def calculate_populairity(gene, gene_sets):
     :param gene: the gene to check the popularity of
     :type gene: str
 
-    :param gene_sets: a map of gene_set names to gene_set objects
+    :param gene_sets: a map of gene_set names to gene_set objects, a data_models.gene_set_collection or a
+                      data_models.gene_set_index
     :type gene_sets: dict
 
     :returns: the number of times the gene appears in the given gene sets
     '''
 
+    if isinstance(gene_sets, gene_set_index):
+        return gene_sets.popularity(gene)
+
+    if isinstance(gene_sets, gene_set_collection):
+        return len(gene_sets.sets_containing(gene))
+
     return sum([1 for key in gene_sets.keys() if gene in gene_sets[key].genes])
 
 def calculate_fold_change(model):
@@ -167,7 +177,7 @@ def calculate_fold_change(model):
     :requires: the model is composed of two gaussian components!
 
     :param model: the mixture model of a given gene
-    :type model: sklearn.mixture.GMM
+    :type model: data_models.gene_mixture
 
     :returns: the fold change of the given gene model as a float
     """
@@ -181,10 +191,123 @@ def calculate_shape_balance(model):
     :requires: the model is composed of two gaussian components!
 
     :param model: the mixture model of a given gene
-    :type model: sklearn.mixture.GMM
+    :type model: data_models.gene_mixture
 
     :returns: The shape imbalance of the gene model
     """
     sigmas = model.covars_
 
-    return max(sigmas[1] / sigmas[0], sigmas[0] / sigmas[1])
\ No newline at end of file
+    return max(sigmas[1] / sigmas[0], sigmas[0] / sigmas[1])
+
+MODEL_STATISTICS = [('prior', 'f8'), ('bayes_error', 'f8'), ('fold_change', 'f8'), ('shape_balance', 'f8'),
+                    ('delta_bic', 'f8')]
+'''The fields calculated by calculate_model_statistics for every gene'''
+
+def calculate_model_statistics(models, values):
+    """
+    Calculates the statistics of calculate_prior, calculate_bayes_error, calculate_fold_change and
+    calculate_shape_balance for every gene of a model table at once, along with the difference in BIC between a one
+    and a two component gaussian model of the gene's expression. A positive delta_bic favours two components.
+
+    :requires: the models are composed of two gaussian components!
+
+    :param models: the mixture model of every gene
+    :type models: data_models.gene_model_table
+
+    :param values: a genes x samples array of the expression levels the models were fitted to, in table order
+    :type values: numpy.ndarray
+
+    :returns: a structured array with a gene field and the MODEL_STATISTICS fields, one record per gene in table order
+    """
+    coeffs = np.asarray(models.weights)
+    mus = np.asarray(models.means)
+    variances = np.asarray(models.variances)
+    sigmas = variances ** 0.5
+
+    statistics = np.empty(len(models), dtype=[('gene', 'U' + str(max([len(gene) for gene in models.genes] + [1])))] +
+                                             MODEL_STATISTICS)
+    statistics['gene'] = models.genes
+    statistics['prior'] = np.minimum(coeffs[:, 0], 1 - coeffs[:, 0])
+    statistics['fold_change'] = np.abs(mus[:, 0] - mus[:, 1])
+    statistics['shape_balance'] = np.maximum(variances[:, 1] / variances[:, 0], variances[:, 0] / variances[:, 1])
+
+    #bayes error, the intersection of the components as in findIntersection, then the false class mass around it
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = sigmas[:, 1] ** 2 - sigmas[:, 0] ** 2
+        b = 2 * sigmas[:, 0] ** 2 * mus[:, 1] - 2 * sigmas[:, 1] ** 2 * mus[:, 0]
+        c = mus[:, 0] ** 2 * sigmas[:, 1] ** 2 - mus[:, 1] ** 2 * sigmas[:, 0] ** 2 - \
+            2 * sigmas[:, 0] ** 2 * sigmas[:, 1] ** 2 * np.log(sigmas[:, 1] / sigmas[:, 0])
+        det = np.sqrt(b ** 2 - 4 * a * c)
+        r1 = (-b + det) / (2 * a)
+        r2 = (-b - det) / (2 * a)
+
+    root = np.where((r1 < mus.max(axis=1)) & (r1 > mus.min(axis=1)), r1, r2)
+    left = root < mus[:, 0]
+    statistics['bayes_error'] = np.where(left,
+                                         norm.sf(root, loc=mus[:, 1], scale=sigmas[:, 1]) * coeffs[:, 1] +
+                                         norm.cdf(root, loc=mus[:, 0], scale=sigmas[:, 0]) * coeffs[:, 0],
+                                         norm.sf(root, loc=mus[:, 0], scale=sigmas[:, 0]) * coeffs[:, 0] +
+                                         norm.cdf(root, loc=mus[:, 1], scale=sigmas[:, 1]) * coeffs[:, 1])
+
+    #BIC of the fitted two component models against a single gaussian, from the mean log likelihoods
+    n = values.shape[1]
+    single = -0.5 * np.log(2 * np.pi * values.var(axis=1)) - 0.5
+    statistics['delta_bic'] = -2 * n * (single - np.asarray(models.log_likelihood)) - 3 * np.log(n)
+
+    return statistics
+
+def candidate_genes(statistics, popularity, min_prior=0.1):
+    """
+    Returns the indices of the genes which can be chosen as master genes, those which appear in at least one gene
+    set and whose prior is at least min_prior, ordered from the smallest bayes error.
+
+    :param statistics: the statistics of every gene, as returned by calculate_model_statistics
+    :type statistics: numpy.ndarray
+
+    :param popularity: a dict mapping gene names to their popularity
+    :type popularity: dict
+
+    :param min_prior: the smallest prior of a candidate
+    :type min_prior: float
+
+    :returns: an array of indices into statistics
+    """
+    popular = np.array([popularity.get(gene, 0) > 0 for gene in statistics['gene']], dtype=bool)
+    candidates = np.flatnonzero(popular & (statistics['prior'] >= min_prior))
+
+    return candidates[np.argsort(statistics['bayes_error'][candidates], kind='stable')]
+
+def select_best_genes(statistics, candidates, configurations, low=0.1, high=0.5):
+    """
+    Divides the prior range [low, high] into evenly sized bins and picks the candidates with the smallest bayes error
+    in every bin, for several binnings at once. A prior of exactly high falls into the last bin.
+
+    :param statistics: the statistics of every gene, as returned by calculate_model_statistics
+    :type statistics: numpy.ndarray
+
+    :param candidates: the indices into statistics of the genes which may be picked
+    :type candidates: numpy.ndarray
+
+    :param configurations: (num_bins, genes_per_bin) pairs, the number of bins and the number of genes to pick in each
+    :type configurations: list
+
+    :returns: a dict mapping every configuration to the indices into statistics of the genes picked for it
+    """
+    candidates = np.asarray(candidates, dtype=int)
+    priors = statistics['prior'][candidates]
+    errors = statistics['bayes_error'][candidates]
+
+    best = {}
+    for num_bins, genes_per_bin in configurations:
+        bins = np.clip(np.digitize(priors, np.linspace(low, high, num_bins + 1)) - 1, 0, num_bins - 1)
+
+        picked = []
+        for bin in range(num_bins):
+            members = np.flatnonzero(bins == bin)
+            if len(members) > genes_per_bin:
+                members = members[np.argpartition(errors[members], genes_per_bin - 1)[:genes_per_bin]]
+            picked.append(candidates[members[np.argsort(errors[members], kind='stable')]])
+
+        best[(num_bins, genes_per_bin)] = np.concatenate(picked)
+
+    return best
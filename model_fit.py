@@ -2,7 +2,11 @@
 Contains methods to fit gene expression to mixed gaussian model using the Expectation Maximization algorithm
 '''
 
-from sklearn.mixture import GMM
+import numpy as np
+from data_models import gene_model_table
+
+MIN_COVAR = 1e-3
+'''Floor added to every fitted variance, as sklearn.mixture.GMM does, so no component collapses onto one sample'''
 
 def fit_test_model(x):
     """
@@ -15,6 +19,8 @@ def fit_test_model(x):
 
     :returns: a sklearn.mixture.GMM, which represents a two component gaussian mixture model
     """
+    from sklearn.mixture import GMM
+
     model = GMM(n_components=2, n_init=5, n_iter=10000, covariance_type='diag')
     model.fit(x)
 
@@ -39,34 +45,202 @@ def print_model_params(gauss_model):
 
     print(string)
 
-def get_trained_models(gene_profiles):
+def _mixture_log_densities(x, weights, means, variances):
+    """
+    Returns the genes x samples x 2 log densities of every sample under each weighted component
+    """
+    x = x[:, :, np.newaxis]
+    return np.log(weights)[:, np.newaxis] - 0.5 * np.log(2 * np.pi * variances)[:, np.newaxis] - \
+           (x - means[:, np.newaxis]) ** 2 / (2 * variances[:, np.newaxis])
+
+def fit_mixtures(values, restarts=5, max_iter=10000, tol=1e-3, seed=None, init=None):
+    """
+    Fits a 2-component gaussian mixture model to the expression of every gene at once by Expectation-Maximization.
+    The parameters of every gene are held in genes x 2 arrays and every E/M step updates all genes still fitting
+    together. A gene stops once its mean log likelihood improves by less than tol, and the best of the restarts is
+    kept per gene. The first restart starts from the quartiles of every gene, the others from random samples.
+
+    :param values: a genes x samples array of expression levels
+    :type values: numpy.ndarray
+
+    :param restarts: the number of initializations to fit from
+    :type restarts: int
+
+    :param max_iter: the maximum number of E/M steps of every restart
+    :type max_iter: int
+
+    :param tol: the improvement of the mean log likelihood under which a gene has converged
+    :type tol: float
+
+    :param seed: the seed of the random initializations
+    :type seed: int
+
+    :param init: a (weights, means, variances) tuple of genes x 2 arrays to start the first restart from instead
+    :type init: tuple
+
+    :returns: a tuple (weights, means, variances, log_likelihood, converged). The first three are genes x 2 arrays,
+              log_likelihood is the mean log likelihood of the samples of every gene and converged is a boolean mask
+              of the genes whose best fit converged
     """
-    Given a mapping of genes to expression values, returns a gaussian model for each gene
+    values = np.asarray(values, dtype=float)
+    genes, n = values.shape
+    rng = np.random.RandomState(seed)
+    spread = values.var(axis=1) + MIN_COVAR
+
+    best = None
+    for restart in range(restarts):
+        if restart == 0 and init is not None:
+            weights, means, variances = [np.array(parameter, dtype=float) for parameter in init]
+        else:
+            if restart == 0:
+                means = np.percentile(values, [25, 75], axis=1).T
+            else:
+                picks = np.array([rng.choice(n, 2, replace=False) for gene in range(genes)])
+                means = np.take_along_axis(values, picks, axis=1)
+            weights = np.full((genes, 2), 0.5)
+            variances = np.repeat(spread[:, np.newaxis], 2, axis=1)
+
+        log_likelihood = np.full(genes, -np.inf)
+        converged = np.zeros(genes, dtype=bool)
+        active = np.arange(genes)
+        for iteration in range(max_iter):
+            x = values[active]
+
+            #E step, responsibilities of each component for every sample of the genes still fitting
+            densities = _mixture_log_densities(x, weights[active], means[active], variances[active])
+            sample_likelihood = np.logaddexp(densities[:, :, 0], densities[:, :, 1])
+            responsibilities = np.exp(densities - sample_likelihood[:, :, np.newaxis])
+
+            current = sample_likelihood.mean(axis=1)
+            done = np.abs(current - log_likelihood[active]) < tol
+            log_likelihood[active] = current
+            converged[active[done]] = True
+
+            active, x, responsibilities = active[~done], x[~done], responsibilities[~done]
+            if len(active) == 0:
+                break
+
+            #M step, only for the genes which have not converged
+            totals = responsibilities.sum(axis=1) + 10 * np.finfo(float).eps
+            weights[active] = totals / n
+            means[active] = np.einsum('gsk,gs->gk', responsibilities, x) / totals
+            variances[active] = np.einsum('gsk,gsk->gk', responsibilities,
+                                          (x[:, :, np.newaxis] - means[active][:, np.newaxis]) ** 2) / totals \
+                                + MIN_COVAR
+
+        print("\t\tRestart " + str(restart + 1) + " of " + str(restarts) + ": " + str(converged.sum()) + " out of " +
+              str(genes) + " genes converged")
+
+        if best is None:
+            best = [weights, means, variances, log_likelihood, converged]
+        else:
+            better = log_likelihood > best[3]
+            for parameter, fitted in zip(best, [weights, means, variances, log_likelihood, converged]):
+                parameter[better] = fitted[better]
+
+    return tuple(best)
+
+def fit_gene_model_table(genes, values, restarts=5, seed=None):
+    """
+    Fits a 2-component gaussian mixture model to the expression of every given gene (see fit_mixtures).
+
+    :param genes: the names of the genes, one per row of values
+    :type genes: list
+
+    :param values: a genes x samples array of expression levels
+    :type values: numpy.ndarray
+
+    :param restarts: the number of initializations to fit every gene from
+    :type restarts: int
+
+    :param seed: the seed of the random initializations
+    :type seed: int
+
+    :return: a data_models.gene_model_table
+    """
+    return gene_model_table(genes, *fit_mixtures(values, restarts, seed=seed))
+
+def refit_gene_model_table(models, genes, values, iterations=20, threshold=0.05, restarts=5, seed=None):
+    """
+    Refits the models of a table to new expression data, such as a cohort which has grown. Every gene of the table
+    starts EM from its fitted parameters and runs only a few iterations. Genes whose warm started mean log likelihood
+    gains more than threshold over the table's parameters evaluated on the new data, and genes missing from the
+    table, are fitted from scratch instead.
+
+    :param models: the models fitted to the previous data
+    :type models: data_models.gene_model_table
+
+    :param genes: the names of the genes, one per row of values
+    :type genes: list
+
+    :param values: a genes x samples array of expression levels
+    :type values: numpy.ndarray
+
+    :param iterations: the maximum number of E/M steps of the warm started fits
+    :type iterations: int
+
+    :param threshold: the gain in mean log likelihood on the new data past which a gene is fitted from scratch
+    :type threshold: float
+
+    :param restarts: the number of initializations of the genes fitted from scratch
+    :type restarts: int
+
+    :param seed: the seed of the random initializations
+    :type seed: int
+
+    :return: a data_models.gene_model_table
+    """
+    values = np.asarray(values, dtype=float)
+    rows = np.array([models.gene_index.get(gene, -1) for gene in genes])
+    known = np.flatnonzero(rows >= 0)
+
+    weights = np.empty((len(genes), 2))
+    means = np.empty((len(genes), 2))
+    variances = np.empty((len(genes), 2))
+    log_likelihood = np.empty(len(genes))
+    converged = np.zeros(len(genes), dtype=bool)
+    fitted = [weights, means, variances, log_likelihood, converged]
+
+    init = (models.weights[rows[known]], models.means[rows[known]], models.variances[rows[known]])
+    for parameter, warm in zip(fitted, fit_mixtures(values[known], 1, iterations, init=init)):
+        parameter[known] = warm
+
+    #the gain of the warm start over the table's parameters on the new data, a large gain means the new samples
+    #moved the fit too far for a few iterations to be trusted
+    densities = _mixture_log_densities(values[known], *init)
+    previous = np.logaddexp(densities[:, :, 0], densities[:, :, 1]).mean(axis=1)
+    moved = log_likelihood[known] - previous > threshold
+    refit = np.concatenate([known[moved], np.flatnonzero(rows < 0)])
+    print("\t\tWarm started " + str(len(known) - moved.sum()) + " genes, refitting " + str(len(refit)) + " from scratch")
+
+    if len(refit) > 0:
+        for parameter, full in zip(fitted, fit_mixtures(values[refit], restarts, seed=seed)):
+            parameter[refit] = full
+
+    return gene_model_table(genes, *fitted)
+
+def get_trained_models(gene_profiles, restarts=5, seed=None):
+    """
+    Given a mapping of genes to expression values, returns a gaussian model for each gene. Every gene is fitted at
+    once by fit_mixtures.
 
     :param gene_profiles: a dictionary of strings representing gene names to lists of floats representing
                           expression values
     :type gene_profiles: dict
 
-    :return: a dict mapping gene names to the trained model of the gene
-    """
-
-    from cache_codec import counter
-    print("\tTraining model for every gene...")
-    i = 0
-    models = {}
-    for gene in gene_profiles.keys():
-        expressions = [[exp] for exp in gene_profiles[gene]]
-        models[gene] = fit_test_model(expressions)
+    :param restarts: the number of initializations to fit every gene from
+    :type restarts: int
 
-        i += 1
-        if i % 100 == 0:
-            print("\t\tTrained " + str(i) + " out of " + str(len(gene_profiles.keys())))
+    :param seed: the seed of the random initializations
+    :type seed: int
 
-    genes = []
-    for gene_sample in gene_profiles:
-        genes.append(gene_sample)
+    :return: a data_models.gene_model_table, which maps gene names to the trained model of the gene
+    """
+    print("\tTraining model for every gene...")
+    genes = [gene for gene in gene_profiles.keys()]
+    values = np.array([gene_profiles[gene] for gene in genes], dtype=float)
 
-    return models
+    return fit_gene_model_table(genes, values, restarts, seed)
 
 if __name__ == "__main__":
 
@@ -93,12 +267,12 @@ if __name__ == "__main__":
     #generated class0/1 phenotype profiles
     MASTER_GENE = "ERBB2"
 
-    gene_sets = cache_codec.load_filtered_gene_sets("BC")
+    gene_sets = cache_codec.load_filtered_gene_set_index("BC")
     enrichment_scores = cache_codec.load_ssGSEA_scores("BC")
     phenotypes = cache_codec.load_sim_phenotypes("BC", 10, MASTER_GENE)
 
     model = cache_codec.load_gene_models("BC")[MASTER_GENE]
-    good_sets = [sets for sets in enrichment_scores.keys() if MASTER_GENE in gene_sets[sets].genes]
+    good_sets = [sets for sets in gene_sets.sets_containing(MASTER_GENE) if sets in enrichment_scores]
     print(good_sets)
 
     import Extra_Modules.gaussian_sampling
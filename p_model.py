@@ -48,8 +48,20 @@ maybe creating distributions of mid, low, and high for every gene. \\
 -Andrew
 '''
 
+import numpy as np
+from functools import lru_cache
+from scipy.special import expit
+from scipy.special import logit
+from scipy.special import logsumexp
 from scipy.stats import beta
 
+MODES = ['low', 'mid', 'high']
+'''The hypotheses of the model, in the order their probabilities are returned by pmodel_matrix'''
+
+hLow = beta(0.5,2)
+hMid = beta(2,2)
+hHigh = beta(2,0.5)
+
 def pmodel(dat1, priors, mode):
     """
     Given normalized expression data, returns the probability that the genes are high, low, or mid expressed
@@ -66,35 +78,157 @@ def pmodel(dat1, priors, mode):
     :return: a probability measuring certainty the expression in the given set are expressed according to the pattern given by mode
     """
 
-    hLow = beta(0.5,2)
-    hMid = beta(2,2)
-    hHigh = beta(2,0.5)
-
-    p1 = priors[0]
-    p2 = priors[1]
-    p3 = priors[2]
-
-    for di in dat1:
-        if di == 0:
-            di = 0.00001
-        if di == 1:
-            di = 0.99999
-        #print(p1,'\t', p2,'\t', p3)
-        p1 = p1 * (hLow.sf(di))
-        p2 = p2 * (min(hMid.sf(di), hMid.cdf(di)) * 2.0)
-        p3 = p3 * (hHigh.cdf(di))
-        
-        ptot = p1 + p2 + p3
-        if ptot == 0:
-            print(p1, '\t', p2, '\t', p3)
-            print(dat1)
-            exit()
-        p1 /= ptot
-        p2 /= ptot
-        p3 /= ptot
+    posteriors = pmodel_matrix(np.array([dat1], dtype=np.float64).reshape(1, -1), priors)[0]
 
     if mode == 'high':
-        return(p3)
+        return(posteriors[2])
     elif mode == 'low':
-        return(p1)
-    return(p2)
\ No newline at end of file
+        return(posteriors[0])
+    return(posteriors[1])
+
+def pmodel_matrix(values, priors, tabulated=False, distributions=None, gene_ids=None):
+    """
+    Vectorized form of pmodel which scores a gene set for every sample at once and returns the probability of all
+    three hypotheses. The likelihoods of every value are evaluated in one call per hypothesis and multiplied in log
+    space, normalizing with logsumexp at the end, so long sets of extreme values no longer underflow to a total of 0.
+
+    :param values: a samples x genes array of gene expression values normalized to (0, 1), one row per sample
+    :type values: numpy.ndarray
+
+    :param priors: a 3 element list with the prior probability that the genes are under, mid, or overexpressed
+    :type priors: list
+
+    :param tabulated: True to look the likelihoods up in precomputed tables (see beta_table) instead of evaluating
+                      the beta distributions with scipy
+    :type tabulated: bool
+
+    :param distributions: optional genes x 3 x 2 array of per gene (a, b) beta parameters for the low, mid and high
+                          hypotheses, as returned by fit_gene_distributions. Replaces the shared distributions.
+    :type distributions: numpy.ndarray
+
+    :param gene_ids: the row of distributions of every column of values, needed when distributions is given
+    :type gene_ids: numpy.ndarray
+
+    :return: a samples x 3 array with the probability of low, mid and high expression of each sample, see MODES.
+             Rows where every hypothesis has zero likelihood are nan.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(values == 0, 0.00001, values)
+    values = np.where(values == 1, 0.99999, values)
+
+    low, mid, high = (hLow, hMid, hHigh)
+    if distributions is not None:
+        parameters = distributions[gene_ids]
+        low, mid, high = [beta(parameters[:, k, 0], parameters[:, k, 1]) for k in range(len(MODES))]
+    elif tabulated:
+        low, mid, high = [get_beta_table(*h.args) for h in (hLow, hMid, hHigh)]
+
+    with np.errstate(divide='ignore'):
+        log_priors = np.log(np.asarray(priors, dtype=np.float64))
+
+        log_likelihoods = np.stack([low.logsf(values).sum(axis=1),
+                                    (np.log(2.0) + np.minimum(mid.logsf(values), mid.logcdf(values))).sum(axis=1),
+                                    high.logcdf(values).sum(axis=1)], axis=1)
+
+    log_posteriors = log_priors + log_likelihoods
+    with np.errstate(invalid='ignore'):
+        return np.exp(log_posteriors - logsumexp(log_posteriors, axis=1, keepdims=True))
+
+
+TABLE_ERROR = 1e-6
+'''The default bound on the absolute error of tabulated log probabilities'''
+
+class beta_table:
+    """
+    Precomputed log survival and log cumulative distribution functions of a beta distribution, evaluated on arrays by
+    linear interpolation. The grid is uniform in logit(x), where the logs of both tails are close to linear, and is
+    refined until the interpolation error at the midpoints between grid points, checked against scipy, is within
+    max_error.
+
+    Values outside of bounds are evaluated as the nearest bound.
+
+    :param a: the first shape parameter of the beta distribution
+    :type a: float
+
+    :param b: the second shape parameter of the beta distribution
+    :type b: float
+
+    :param max_error: the largest absolute error allowed in the tabulated log probabilities
+    :type max_error: float
+
+    :param bounds: the smallest and largest values tabulated
+    :type bounds: tuple
+    """
+    MAX_POINTS = 2 ** 22
+
+    def __init__(self, a, b, max_error=TABLE_ERROR, bounds=(1e-9, 1 - 1e-9)):
+        self.a = a
+        self.b = b
+        self.max_error = max_error
+
+        points = 1025
+        low, high = logit(bounds[0]), logit(bounds[1])
+        while True:
+            self.grid = np.linspace(low, high, points)
+            self.log_sf = beta.logsf(expit(self.grid), a, b)
+            self.log_cdf = beta.logcdf(expit(self.grid), a, b)
+
+            midpoints = expit((self.grid[1:] + self.grid[:-1]) / 2)
+            self.error = max(np.abs(self.logsf(midpoints) - beta.logsf(midpoints, a, b)).max(),
+                             np.abs(self.logcdf(midpoints) - beta.logcdf(midpoints, a, b)).max())
+
+            if self.error <= max_error:
+                break
+            if points > self.MAX_POINTS:
+                raise ValueError("Could not tabulate beta(" + str(a) + ", " + str(b) + ") within " + str(max_error))
+            points = 2 * points - 1
+
+    def logsf(self, x):
+        """
+        Returns the tabulated log survival function at every value of x
+        """
+        return np.interp(logit(x), self.grid, self.log_sf)
+
+    def logcdf(self, x):
+        """
+        Returns the tabulated log cumulative distribution function at every value of x
+        """
+        return np.interp(logit(x), self.grid, self.log_cdf)
+
+@lru_cache(maxsize=16)
+def get_beta_table(a, b, max_error=TABLE_ERROR):
+    """
+    Returns the beta_table of the given beta distribution, building it on first use
+    """
+    return beta_table(a, b, max_error)
+
+def fit_gene_distributions(values):
+    """
+    Fits a low, mid and high beta distribution to every gene, rather than sharing one set of distributions between
+    all genes. The normalized expression values of each gene are split into thirds and a beta distribution is fitted
+    to the lowest, middle and highest third by the method of moments. A third with too little spread to fit falls back
+    to the shared distribution of its hypothesis.
+
+    All genes given are fitted at once, so pass batches of genes rather than one gene at a time.
+
+    :param values: a genes x samples array of gene expression values normalized to (0, 1)
+    :type values: numpy.ndarray
+
+    :return: a genes x 3 x 2 array holding the (a, b) parameters of the low, mid and high distribution of every gene
+    """
+    values = np.sort(np.asarray(values, dtype=np.float64), axis=1)
+    thirds = np.array_split(np.arange(values.shape[1]), len(MODES))
+
+    distributions = np.empty((values.shape[0], len(MODES), 2))
+    for k, (columns, shared) in enumerate(zip(thirds, (hLow, hMid, hHigh))):
+        mean = np.clip(values[:, columns].mean(axis=1), 0.001, 0.999)
+        variance = values[:, columns].var(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            common = mean * (1 - mean) / variance - 1
+        fitted = np.isfinite(common) & (common > 0)
+
+        distributions[:, k, 0] = np.where(fitted, mean * common, shared.args[0])
+        distributions[:, k, 1] = np.where(fitted, (1 - mean) * common, shared.args[1])
+
+    return distributions
@@ -25,7 +25,7 @@ def get_ranking_data(enrichment_ranks):
     :return: a mapping of master genes to a list or lists
     '''
 
-    gene_sets = cache_codec.load_filtered_gene_sets('BC')
+    gene_sets = cache_codec.load_filtered_gene_set_index('BC')
 
     ranks = {}
 
@@ -34,11 +34,7 @@ def get_ranking_data(enrichment_ranks):
         ranks[gene] = []
         p_values_gene = enrichment_ranks[gene]
 
-        good_sets = {1}
-        good_sets.clear()
-        for set in gene_sets:
-            if gene in gene_sets[set].genes:
-                good_sets.add(set)
+        good_sets = {name for name in gene_sets.sets_containing(gene)}
 
         for trial in p_values_gene:
             trial_rank = []
@@ -0,0 +1,53 @@
+'''
+Hands out the random streams used across the pipeline. Every (stage, master gene, replicate) draws from its own
+independent numpy.random.Generator, spawned from one run seed through numpy.random.SeedSequence. A stream only
+depends on its key and the run seed, so serial and parallel runs draw the same numbers however the work is split
+between processes.
+'''
+
+import numpy as np
+
+DEFAULT_SEED = 0
+'''The run seed used when none is given'''
+
+STAGES = ['simulation', 'subsample', 'scramble', 'null', 'nes']
+'''The stages of the pipeline which draw random numbers. A stage is keyed by its position, so only append to this'''
+
+def stream_key(stage, master_gene='', replicate=0):
+    """
+    Returns the spawn key of a stream, the path of the stream in the tree of streams spawned from the run seed.
+
+    :param stage: the stage drawing from the stream, one of STAGES
+    :type stage: str
+
+    :param master_gene: the master gene, or other name, the stream draws for. Names are keyed by their length and
+                        every byte of their UTF-8 encoding, so no two names share a stream.
+    :type master_gene: str
+
+    :param replicate: the replicate the stream draws for
+    :type replicate: int
+
+    :returns: a tuple of non-negative ints
+    """
+    name = str(master_gene).encode('utf-8')
+    return (STAGES.index(stage), int(replicate), len(name)) + tuple(name)
+
+def seed_sequence(stage, master_gene='', replicate=0, seed=DEFAULT_SEED):
+    """
+    Returns the numpy.random.SeedSequence of a stream (see stream_key). This is the child the run seed's sequence
+    would spawn at the stream's key.
+
+    :param seed: the run seed, None for fresh entropy from the OS
+    :type seed: int
+    """
+    return np.random.SeedSequence(seed, spawn_key=stream_key(stage, master_gene, replicate))
+
+def generator(stage, master_gene='', replicate=0, seed=DEFAULT_SEED):
+    """
+    Returns a numpy.random.Generator drawing the stream of the given stage, master gene and replicate under the given
+    run seed (see stream_key).
+
+    :param seed: the run seed, None for fresh entropy from the OS
+    :type seed: int
+    """
+    return np.random.Generator(np.random.PCG64(seed_sequence(stage, master_gene, replicate, seed)))
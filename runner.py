@@ -6,51 +6,83 @@ from multiprocessing import Pool
 import numpy
 
 #import cache_codec
-from cache_codec import load_sim_phenotype_keyed
+from cache_codec import iterate_sim_phenotypes
+from cache_codec import load_expression_matrix
 from cache_codec import load_gene_popularity
 from cache_codec import load_ssGSEA_scores
-from cache_codec import load_filtered_gene_sets
+from cache_codec import load_ssGSEA_nes
+from cache_codec import load_filtered_gene_set_collection
 from cache_codec import load_best_models
 from cache_codec import load_bayes_scores
 from cache_codec import load_null_scores
 
-from analyze_enrichment import rank_by_t_test_keyed
+from analyze_enrichment import rank_by_t_test_masks
 from analyze_enrichment import evaluate_rankings_keyed
 
+from random_streams import DEFAULT_SEED
+from random_streams import generator
+
 import pickle
-import random
 import sys
 
 DEFAULT_NUM_PROCESSES = 7
 
-def run_analysis_on_dataset(NUM_PROCESSES, data_set, n, pheno_sample, gene_options='all', test='ssGSEA'):
+def rank_master_gene(enrichment_scores, data_set, n, master_gene, pheno_sample, seed=DEFAULT_SEED):
+    '''
+    Ranks the gene sets by t-test for every simulated phenotype of the given master gene, each restricted to
+    pheno_sample randomly chosen samples. Phenotypes are simulated lazily inside the worker, and every replicate
+    subsamples from its own stream of the run seed (see random_streams). Returns a map of the master gene to the
+    rankings.
+    '''
+    print("\tRunning T-Test " + master_gene)
+    ids = load_expression_matrix(data_set).ids
+
+    samples = numpy.empty((n, pheno_sample), dtype=int)
+    for replicate in range(n):
+        stream = generator('subsample', master_gene, replicate, seed)
+        samples[replicate] = stream.choice(len(ids), pheno_sample, replace=False)
+
+    masks = iterate_sim_phenotypes(data_set, n, master_gene, seed)
+    return {master_gene: rank_by_t_test_masks(enrichment_scores, ids, masks, samples, n)}
+
+def run_analysis_on_dataset(NUM_PROCESSES, data_set, n, pheno_sample, gene_options='all', test='ssGSEA', jobs=None,
+                            seed=DEFAULT_SEED):
     '''
-    Runs gene set enrichment analysis with a chosen single sample method
+    Runs gene set enrichment analysis with a chosen single sample method. jobs is the number of processes used to
+    compute enrichment scores which are not cached yet, and defaults to NUM_PROCESSES. seed is the run seed every
+    random draw of the analysis derives from (see random_streams).
     '''
 
+    if jobs is None:
+        jobs = NUM_PROCESSES
+
     print("Starting analysis...")
     master_genes = load_gene_popularity(data_set).keys()
 
     enrichment_scores = None
     if test == 'ssGSEA':
-        enrichment_scores = load_ssGSEA_scores(data_set)
+        enrichment_scores = load_ssGSEA_scores(data_set, '', jobs)
+    elif test == 'ssGSEA_nes':
+        enrichment_scores = load_ssGSEA_nes(data_set, seed=seed)[0]
     elif test == 'bayes_low':
-        enrichment_scores = load_bayes_scores(data_set, 'low')
+        enrichment_scores = load_bayes_scores(data_set, 'low', jobs=jobs)
     elif test == 'bayes_mid':
-        enrichment_scores = load_bayes_scores(data_set, 'mid')
+        enrichment_scores = load_bayes_scores(data_set, 'mid', jobs=jobs)
     elif test == 'bayes_high':
-        enrichment_scores = load_bayes_scores(data_set, 'high')
+        enrichment_scores = load_bayes_scores(data_set, 'high', jobs=jobs)
+    elif test in ('bayes_gene_low', 'bayes_gene_mid', 'bayes_gene_high'):
+        enrichment_scores = load_bayes_scores(data_set, test[len('bayes_gene_'):], '', True, jobs=jobs)
     elif test == "null":
-        enrichment_scores = load_null_scores(data_set)
+        enrichment_scores = load_null_scores(data_set, seed=seed)
     elif test == "bayes_mid_null":
-        enrichment_scores = load_bayes_scores(data_set, 'mid', 'null')
+        enrichment_scores = load_bayes_scores(data_set, 'mid', 'null', jobs=jobs, seed=seed)
     elif test == "ssGSEA_null":
-        enrichment_scores = load_ssGSEA_scores(data_set, 'null')
+        enrichment_scores = load_ssGSEA_scores(data_set, 'null', jobs, seed=seed)
     else:
         print("ERROR, invalid enrichment test!")
         return
 
-    gene_sets = load_filtered_gene_sets(data_set)
+    gene_sets = load_filtered_gene_set_collection(data_set)
     best_models = load_best_models("BC", 10, 10)
 
     good_genes = []
@@ -62,25 +94,9 @@ def run_analysis_on_dataset(NUM_PROCESSES, data_set, n, pheno_sample, gene_optio
     #ToDo: find way to do this without spawning proccesses
     pool = Pool(processes=NUM_PROCESSES)
 
-    #load phenotypes, maps master gene to phenotype
-    pheno_params = [(data_set, n, good_gene) for good_gene in good_genes]
-    loaded_phenos = pool.starmap(load_sim_phenotype_keyed, pheno_params)
-
-    #process into more usable form of master gene -> phenotypes
-    pheno_map = {}
-    for map in loaded_phenos:
-        for key in map.keys():
-            sampled_pheno_map = []
-            for phenotype in map[key]:
-                sampled_keys = random.sample(phenotype.keys(), pheno_sample)
-                sampled_map = {id: phenotype[id] for id in sampled_keys}
-                sampled_pheno_map.append(sampled_map)
-
-            pheno_map[key] = sampled_pheno_map
-    print("Calculated phenotypes")
-
     #work out the enrichment_score ranks
-    enrichment_list = pool.starmap(rank_by_t_test_keyed, [(enrichment_scores, pheno_map[gene], gene) for gene in good_genes])
+    enrichment_list = pool.starmap(rank_master_gene, [(enrichment_scores, data_set, n, gene, pheno_sample, seed)
+                                                      for gene in good_genes])
     enrichment_map = {}
     for enrichment in enrichment_list:
         for key in enrichment.keys():
@@ -117,8 +133,19 @@ def run_analysis_on_dataset(NUM_PROCESSES, data_set, n, pheno_sample, gene_optio
     f.close()
 
 def main(argv):
+    #optional --jobs=N sets the processes used for computing enrichment scores, --seed=N the run seed
+    jobs = None
+    for arg in [arg for arg in argv if arg.startswith("--jobs=")]:
+        jobs = int(arg[len("--jobs="):])
+        argv.remove(arg)
+
+    seed = DEFAULT_SEED
+    for arg in [arg for arg in argv if arg.startswith("--seed=")]:
+        seed = int(arg[len("--seed="):])
+        argv.remove(arg)
+
     if len(argv) < 5:
-        print("Usage: python runner.py [NUM_PROCESSES] [DATA_SET] [REPLICATES] [SAMPLES_PER_REPLICATE] [TEST: ssGSEA | bayes_high | bayes_low | bayes_mid] <...GENES, empty for all>")
+        print("Usage: python runner.py [NUM_PROCESSES] [DATA_SET] [REPLICATES] [SAMPLES_PER_REPLICATE] [TEST: ssGSEA | ssGSEA_nes | bayes_high | bayes_low | bayes_mid | bayes_gene_high | bayes_gene_low | bayes_gene_mid] <...GENES, empty for all> <--jobs=N> <--seed=N>")
         return
 
     NUM_PROCESSES = int(argv[0])
@@ -138,7 +165,8 @@ def main(argv):
     #run algo
     import timeit
     start = timeit.default_timer()
-    run_analysis_on_dataset(NUM_PROCESSES, DATA_SET, REPLICATES, SAMPLES_PER_REPLICATE, gene_options=genes, test=TEST)
+    run_analysis_on_dataset(NUM_PROCESSES, DATA_SET, REPLICATES, SAMPLES_PER_REPLICATE, gene_options=genes, test=TEST,
+                            jobs=jobs, seed=seed)
     end = timeit.default_timer()
 
     #reset output to terminal and print results!
@@ -1,11 +1,14 @@
 '''
 This module contains methods for simulating data given a hybrid data model
 '''
-import random
+import numpy as np
+from scipy.special import expit
 from scipy.stats import norm
+from random_streams import DEFAULT_SEED
+from random_streams import generator
 
 
-def simulate_data(models, master_gene_name, sample_profiles, n):
+def simulate_data(models, master_gene_name, sample_profiles, n, replicate=0, seed=DEFAULT_SEED):
     """
     Given a list of gaussian mixture models for genes, a master gene, and a list of sample profiles,
     returns n simulated phenotypes for each sample profile. This is done by selection of sample profiles
@@ -14,7 +17,8 @@ def simulate_data(models, master_gene_name, sample_profiles, n):
 
     :requires: n is positive and less than or equal to len(sample_profiles)
 
-    :param models: a mapping of gene names to the gaussian mixture model (GMM) for each gene.
+    :param models: a mapping of gene names to the gaussian mixture model (GMM) for each gene, such as a
+                   data_models.gene_model_table
     :type models: dict
 
     :param master_gene_name: the gene to be used as the master gene for phenotype simulation
@@ -26,15 +30,22 @@ def simulate_data(models, master_gene_name, sample_profiles, n):
     :param n: the number of phenotypes to simulate
     :type n: int
 
+    :param replicate: the replicate simulated, which picks its random stream (see random_streams)
+    :type replicate: int
+
+    :param seed: the run seed
+    :type seed: int
+
     :return: a dict mapping sample id's to phenotype classes. This phenotype does not necessarily correspond
              to any real phenotype but rather the components of the mixture model of the master gene. class 0 represents
              the component in the model with a smaller expression mean while class 1 represents the one with the larger.
     """
 
     master_gene_model = models[master_gene_name]
+    stream = generator('simulation', master_gene_name, replicate, seed)
 
     #for selecting random front n values
-    random.shuffle(sample_profiles)
+    sample_profiles[:] = [sample_profiles[i] for i in stream.permutation(len(sample_profiles))]
 
     classifications = {}
     for i in range(0, n):
@@ -69,9 +80,95 @@ def simulate_data(models, master_gene_name, sample_profiles, n):
 
         probability1 = proportions1 * density1 / (proportions1 * density1 + proportions0 * density0)
 
-        if random.random() <= probability1:
+        if stream.random() <= probability1:
             classifications[id] = 1
         else:
             classifications[id] = 0
 
-    return classifications
\ No newline at end of file
+    return classifications
+
+def class1_posterior(model, intensities):
+    """
+    Returns the probability of every sample belonging to class 1 of the master gene's mixture model, the component
+    with the larger expression mean, given the sample's expression of the master gene.
+
+    :param model: the gaussian mixture model of the master gene
+    :type model: data_models.gene_mixture
+
+    :param intensities: the master gene's expression level in every sample
+    :type intensities: numpy.ndarray
+
+    :return: an array with the class 1 probability of every sample
+    """
+    proportions = np.asarray(model.weights_)
+    mus = np.asarray(model.means_)[:, 0]
+    sigmas = np.asarray(model.covars_)[:, 0] ** 0.5
+
+    #setting 0/1 to the proper low/high peaks. 0 = smaller mu
+    low, high = (0, 1) if mus[0] < mus[1] else (1, 0)
+
+    log_density0 = np.log(proportions[low]) + norm.logpdf(intensities, loc=mus[low], scale=sigmas[low])
+    log_density1 = np.log(proportions[high]) + norm.logpdf(intensities, loc=mus[high], scale=sigmas[high])
+
+    return expit(log_density1 - log_density0)
+
+def simulate_phenotypes(model, intensities, n, master_gene='', seed=DEFAULT_SEED, first=0):
+    """
+    Simulates n phenotypes for every sample. Every sample's class 1 probability is calculated once from the master
+    gene's mixture model. The replicates are then simulated one at a time (see generate_phenotypes): each replicate
+    draws the classes of all samples in one Bernoulli draw from its own random stream (see random_streams), so any
+    range of replicates can be simulated on its own and gives the same classes.
+
+    :param model: the gaussian mixture model of the master gene
+    :type model: data_models.gene_mixture
+
+    :param intensities: the master gene's expression level in every sample
+    :type intensities: numpy.ndarray
+
+    :param n: the number of phenotypes to simulate
+    :type n: int
+
+    :param master_gene: the name of the master gene, which keys its random streams
+    :type master_gene: str
+
+    :param seed: the run seed
+    :type seed: int
+
+    :param first: the replicate number of the first phenotype simulated
+    :type first: int
+
+    :return: an n x samples uint8 array of classes, 1 for the component with the larger expression mean and 0 for
+             the other, with samples in the order of intensities
+    """
+    posterior = class1_posterior(model, np.asarray(intensities, dtype=float))
+
+    labels = np.empty((n, len(posterior)), dtype=np.uint8)
+    for row, mask in enumerate(generate_phenotypes(posterior, n, master_gene, seed, first)):
+        labels[row] = mask
+
+    return labels
+
+def generate_phenotypes(posterior, n, master_gene='', seed=DEFAULT_SEED, first=0):
+    """
+    Lazily simulates n phenotypes from every sample's class 1 probability, yielding one replicate at a time. The
+    replicates are the rows simulate_phenotypes would return for the same master gene and seed.
+
+    :param posterior: the class 1 probability of every sample, as returned by class1_posterior
+    :type posterior: numpy.ndarray
+
+    :param n: the number of phenotypes to simulate
+    :type n: int
+
+    :param master_gene: the name of the master gene, which keys its random streams
+    :type master_gene: str
+
+    :param seed: the run seed
+    :type seed: int
+
+    :param first: the replicate number of the first phenotype simulated
+    :type first: int
+
+    :return: a generator of boolean arrays, True for the class 1 samples of a replicate
+    """
+    for replicate in range(first, first + n):
+        yield generator('simulation', master_gene, replicate, seed).random(len(posterior)) < posterior
@@ -4,30 +4,51 @@ This file contains script for emulating the ssGSEA algorithm from Barbie et al.
 
 import numpy as np
 from simulation import *
+from random_streams import DEFAULT_SEED
+from random_streams import generator
 
-def calculate_enrichment_score(gene_set, expressions, omega):
+def calculate_enrichment_score(gene_set, expressions, omega, running=True, ranks=None):
     """
     Given a gene set, a map of gene names to expression levels, and a weight omega, returns the ssGSEA
     enrichment score for the gene set as described by *D. Barbie et al 2009*
 
-    :requires: every member of gene_set is a key in expressions
+    :requires: every member of gene_set is a key in expressions, or in ranks when it is given
 
     :param gene_set: a set of gene_names in the set
     :type gene_set: set
 
-    :param expressions: a dictionary mapping gene names to their expression values
+    :param expressions: a dictionary mapping gene names to their expression values. Not needed, and may be None,
+                        when ranks is given.
     :type expressions: dict
 
     :param omega: the weighted exponent on the :math:`P^W_G` term.
     :type omega: float
 
+    :param running: True to return the intermediate scores (for plotting and leading edge analysis), False to only
+                    return the total enrichment score. See enrichment_score.
+    :type running: bool
+
+    :param ranks: for running=False, the precomputed rank (starting from 1, highest expression first) of every gene,
+                  e.g. data_models.rank_index.sample_ranks. Only the genes of the set are looked up, so the total is
+                  found in O(|set|) time, and len(ranks) is taken as the number of genes. If None, the genes are
+                  ranked from expressions first.
+    :type ranks: data_models.sample_ranks
+
     :returns: an array representing the intermediate Enrichment Scores for each step along the sorted gene list.
-              To find the total enrichment score, take the sum of all values in the array.
+              To find the total enrichment score, take the sum of all values in the array. If running is False,
+              returns that total instead.
     """
 
+    if not running and ranks is not None:
+        return enrichment_score([ranks[gene] for gene in gene_set], len(ranks), omega)
+
     #first sort by absolute expression value, starting with the highest expressed genes first
     keys_sorted = sorted(expressions, key=expressions.get, reverse=True)
 
+    if not running:
+        set_ranks = [i for i, gene in enumerate(keys_sorted, 1) if gene in gene_set]
+        return enrichment_score(set_ranks, len(expressions), omega)
+
     #values representing the ECDF of genes in the geneset
     P_GW_numerator = 0
     P_GW_denominator = 0
@@ -59,3 +80,247 @@ def calculate_enrichment_score(gene_set, expressions, omega):
         i += 1
 
     return scores
+
+def enrichment_score(set_ranks, n, omega, weights=None):
+    """
+    Returns the total enrichment score of a gene set, the sum of the intermediate scores of
+    calculate_enrichment_score, from the ranks of the set's genes alone. The running sums are never built, so the cost
+    grows with the size of the set rather than the number of genes.
+
+    A gene in the set at rank r adds :math:`r^{omega}` over the :math:`P^W_G` denominator to every step from r
+    onwards and a gene not in the set adds :math:`1 / (N - |G|)`, which sums to
+
+    :math:`\\sum_G r^{omega} (N - r + 1) / \\sum_G r^{omega} - (N (N + 1) / 2 - \\sum_G (N - r + 1)) / (N - |G|)`
+
+    :param set_ranks: the ranks (starting from 1, highest expression first) of every gene in the set
+    :type set_ranks: list
+
+    :param n: the total number of ranked genes
+    :type n: int
+
+    :param omega: the weighted exponent on the :math:`P^W_G` term.
+    :type omega: float
+
+    :param weights: optional precomputed weights, entry i - 1 holding :math:`i^{omega}`, e.g. rank_index.weights
+    :type weights: numpy.ndarray
+
+    :returns: the total enrichment score as a float
+    """
+    set_ranks = np.asarray(set_ranks, dtype=np.int64)
+
+    if weights is None:
+        set_weights = set_ranks.astype(np.float64) ** omega
+    else:
+        set_weights = weights[set_ranks - 1]
+    tails = n - set_ranks + 1
+
+    P_GW_total = np.dot(set_weights, tails) / set_weights.sum()
+    P_NG_total = (n * (n + 1) / 2 - tails.sum()) / (n - len(set_ranks))
+
+    return float(P_GW_total - P_NG_total)
+
+def rank_matrix(expressions):
+    """
+    Given a genes x samples matrix of expression values, returns the rank of every gene within each sample. Rank 1 is
+    the highest expressed gene, and ties keep their row order just as sorting by expression does in
+    calculate_enrichment_score.
+
+    :param expressions: a genes x samples array of expression values
+    :type expressions: numpy.ndarray
+
+    :returns: a genes x samples array of ranks starting from 1, stored as uint16 when there are few enough genes and
+              uint32 otherwise
+    """
+    n = expressions.shape[0]
+    dtype = np.uint16 if n <= np.iinfo(np.uint16).max else np.uint32
+
+    order = np.argsort(-expressions, axis=0, kind='stable')
+    ranks = np.empty(order.shape, dtype=dtype)
+    np.put_along_axis(ranks, order, np.arange(1, n + 1, dtype=dtype)[:, np.newaxis], axis=0)
+
+    return ranks
+
+def calculate_enrichment_scores(expressions, incidence, omega):
+    """
+    Vectorized form of calculate_enrichment_score which scores every sample against every gene set at once, returning
+    the total enrichment score (the sum of the intermediate scores) for each pair. See
+    calculate_enrichment_scores_from_ranks.
+
+    :requires: every gene in incidence is a row of expressions
+
+    :param expressions: a genes x samples array of expression values
+    :type expressions: numpy.ndarray
+
+    :param incidence: a sets x genes matrix (dense or scipy.sparse) with a 1 where a gene is in a set
+    :type incidence: numpy.ndarray
+
+    :param omega: the weighted exponent on the :math:`P^W_G` term.
+    :type omega: float
+
+    :returns: a samples x sets array of total enrichment scores
+    """
+    ranks = rank_matrix(expressions)
+    weights = np.arange(1, ranks.shape[0] + 1, dtype=np.float64) ** omega
+
+    return calculate_enrichment_scores_from_ranks(ranks, weights, incidence)
+
+def calculate_enrichment_scores_from_ranks(ranks, weights, incidence):
+    """
+    Returns the total enrichment score of every sample against every gene set from precomputed ranks, so samples are
+    never sorted again. This is enrichment_score for all sets and samples at once, with the sums over the ranks of
+    the set members computed as matrix products.
+
+    :param ranks: a genes x samples array of ranks starting from 1, as returned by rank_matrix
+    :type ranks: numpy.ndarray
+
+    :param weights: the weight of every rank, entry i - 1 holding :math:`i^{omega}`
+    :type weights: numpy.ndarray
+
+    :param incidence: a sets x genes matrix (dense or scipy.sparse) with a 1 where a gene is in a set
+    :type incidence: numpy.ndarray
+
+    :returns: a samples x sets array of total enrichment scores
+    """
+    return calculate_enrichment_score_sweep_from_ranks(ranks, weights[np.newaxis, :], incidence)[0]
+
+def calculate_enrichment_score_sweep(gene_set, expressions, omegas):
+    """
+    As calculate_enrichment_score with running set to False, but returns the total enrichment score for every weight
+    in omegas while sorting the expressions only once.
+
+    :requires: every member of gene_set is a key in expressions
+
+    :param gene_set: a set of gene_names in the set
+    :type gene_set: set
+
+    :param expressions: a dictionary mapping gene names to their expression values
+    :type expressions: dict
+
+    :param omegas: the weighted exponents on the :math:`P^W_G` term to score with
+    :type omegas: list
+
+    :returns: an array with the total enrichment score for each omega
+    """
+    keys_sorted = sorted(expressions, key=expressions.get, reverse=True)
+    set_ranks = [i for i, gene in enumerate(keys_sorted, 1) if gene in gene_set]
+
+    return np.array([enrichment_score(set_ranks, len(expressions), omega) for omega in omegas])
+
+def calculate_enrichment_scores_sweep(expressions, incidence, omegas):
+    """
+    As calculate_enrichment_scores, but scores every weight in omegas from a single ranking of the samples.
+
+    :param expressions: a genes x samples array of expression values
+    :type expressions: numpy.ndarray
+
+    :param incidence: a sets x genes matrix (dense or scipy.sparse) with a 1 where a gene is in a set
+    :type incidence: numpy.ndarray
+
+    :param omegas: the weighted exponents on the :math:`P^W_G` term to score with
+    :type omegas: list
+
+    :returns: an omegas x samples x sets array of total enrichment scores
+    """
+    ranks = rank_matrix(expressions)
+    weights = np.arange(1, ranks.shape[0] + 1, dtype=np.float64)[np.newaxis, :] ** np.reshape(omegas, (-1, 1))
+
+    return calculate_enrichment_score_sweep_from_ranks(ranks, weights, incidence)
+
+def calculate_enrichment_score_sweep_from_ranks(ranks, weights, incidence):
+    """
+    As calculate_enrichment_scores_from_ranks, but for several weightings of the ranks at once. The
+    :math:`P^N_G` part of the score does not depend on omega, so it is computed a single time for all of them.
+
+    :param ranks: a genes x samples array of ranks starting from 1, as returned by rank_matrix
+    :type ranks: numpy.ndarray
+
+    :param weights: an omegas x genes array where entry (k, i - 1) holds the weight of rank i for the k-th omega
+    :type weights: numpy.ndarray
+
+    :param incidence: a sets x genes matrix (dense or scipy.sparse) with a 1 where a gene is in a set
+    :type incidence: numpy.ndarray
+
+    :returns: an omegas x samples x sets array of total enrichment scores
+    """
+    n = ranks.shape[0]
+
+    positions = ranks.astype(np.intp) - 1
+    tails = n - ranks.astype(np.float64) + 1
+
+    set_tails = incidence @ tails
+    set_sizes = np.asarray(incidence.sum(axis=1)).reshape(-1, 1)
+
+    P_NG_total = (n * (n + 1) / 2 - set_tails) / (n - set_sizes)
+
+    scores = np.empty((len(weights), ranks.shape[1], incidence.shape[0]))
+    for k in range(len(weights)):
+        rank_weights = weights[k][positions]
+
+        P_GW_denominator = incidence @ rank_weights
+        P_GW_total = incidence @ (rank_weights * tails)
+
+        scores[k] = np.asarray(P_GW_total / P_GW_denominator - P_NG_total).T
+
+    return scores
+
+def calculate_normalized_enrichment_scores(ranks, weights, incidence, permutations=1000, seed=DEFAULT_SEED):
+    """
+    Returns normalized enrichment scores and empirical p-values for every sample against every gene set, so that
+    scores of sets with different sizes can be compared.
+
+    Random gene sets are drawn for every set size in incidence and scored in one batch against the precomputed ranks,
+    so all sets of the same size share one null distribution. The random sets of every size are the leading genes of
+    the same random draws, which only costs one draw per permutation. As in GSEA, a positive score is divided by the
+    mean of the positive null scores of its sample and a negative score by the mean magnitude of the negative ones.
+    The p-value of a score is the fraction of null scores of the same sign which are at least as extreme.
+
+    :param ranks: a genes x samples array of ranks starting from 1, as returned by rank_matrix
+    :type ranks: numpy.ndarray
+
+    :param weights: the weight of every rank, entry i - 1 holding :math:`i^{omega}`
+    :type weights: numpy.ndarray
+
+    :param incidence: a sets x genes scipy.sparse.csr_matrix with a 1 where a gene is in a set
+    :type incidence: scipy.sparse.csr_matrix
+
+    :param permutations: the number of random gene sets drawn for every set size
+    :type permutations: int
+
+    :param seed: the run seed of the random gene sets, each permutation drawing from its own stream (see
+                 random_streams)
+    :type seed: int
+
+    :returns: a tuple (nes, pvalues) of samples x sets arrays
+    """
+    from scipy.sparse import csr_matrix
+
+    n = ranks.shape[0]
+
+    scores = calculate_enrichment_scores_from_ranks(ranks, weights, incidence)
+    sizes = np.diff(incidence.indptr)
+
+    draws = np.array([generator('nes', '', i, seed).choice(n, sizes.max(), replace=False) for i in range(permutations)])
+
+    nes = np.empty(scores.shape)
+    pvalues = np.empty(scores.shape)
+    for size in np.unique(sizes):
+        members = draws[:, :size]
+        null_incidence = csr_matrix((np.ones(members.size), members.ravel(), np.arange(0, members.size + 1, size)),
+                                    shape=(permutations, n))
+        null = calculate_enrichment_scores_from_ranks(ranks, weights, null_incidence)[:, :, np.newaxis]
+
+        sets = np.flatnonzero(sizes == size)
+        observed = scores[:, np.newaxis, sets]
+
+        positive = (null >= 0).sum(axis=1)
+        negative = permutations - positive
+        with np.errstate(divide='ignore', invalid='ignore'):
+            positive_mean = np.where(null >= 0, null, 0).sum(axis=1) / positive
+            negative_mean = -np.where(null < 0, null, 0).sum(axis=1) / negative
+
+            nes[:, sets] = np.where(observed[:, 0] >= 0, observed[:, 0] / positive_mean, observed[:, 0] / negative_mean)
+            pvalues[:, sets] = np.where(observed[:, 0] >= 0,
+                                        (1 + ((null >= observed) & (null >= 0)).sum(axis=1)) / (1 + positive),
+                                        (1 + ((null <= observed) & (null < 0)).sum(axis=1)) / (1 + negative))
+
+    return (nes, pvalues)
@@ -0,0 +1,74 @@
+'''
+Checks the streamed enrichment scores of cache_codec against the in memory ones on a small made up dataset
+'''
+
+import pickle
+import sqlite3
+
+import numpy as np
+import pytest
+
+import cache_codec
+from data_models import expression_profile
+from data_models import gene_set
+from data_models import sample
+
+DATASET = "BC"
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    '''
+    Caches a dataset of 12 samples and 200 genes both as sample profiles and in the expression database, along with
+    25 gene sets, under a temporary data directory.
+    '''
+    monkeypatch.setattr(cache_codec, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(cache_codec, "GENE_SET_FILE", str(tmp_path) + "/All_GeneSets.pkl")
+    for value in vars(cache_codec).values():
+        if hasattr(value, "cache_clear"):
+            value.cache_clear()
+
+    rng = np.random.default_rng(0)
+    genes = ["g" + str(i) for i in range(200)]
+    ids = list(range(100, 112))
+    values = rng.normal(size=(len(genes), len(ids)))
+
+    samples = {id: sample({gene: expression_profile(id, gene, values[row, column], {})
+                           for row, gene in enumerate(genes)}, id) for column, id in enumerate(ids)}
+    (tmp_path / DATASET).mkdir()
+    pickle.dump(samples, open(cache_codec.EXPRESSION_PROFILES_FILE(DATASET), 'wb'))
+
+    connection = sqlite3.connect(cache_codec.EXPRESSION_PROFILE_DB(DATASET))
+    connection.execute("Create Table " + cache_codec.EXPRESSION_PROFILE_DBTABLE(DATASET) +
+                       " (Sample, Gene, Intensity)")
+    connection.executemany("Insert Into " + cache_codec.EXPRESSION_PROFILE_DBTABLE(DATASET) + " Values (?, ?, ?)",
+                           [(id, gene, values[row, column]) for column, id in enumerate(ids)
+                            for row, gene in enumerate(genes)])
+    connection.commit()
+    connection.close()
+
+    gene_sets = {"s" + str(k): gene_set("s" + str(k), "", set(rng.choice(genes, int(rng.integers(6, 40)), False)))
+                 for k in range(25)}
+    pickle.dump(gene_sets, open(cache_codec.GENE_SET_FILE, 'wb'))
+
+    return DATASET
+
+@pytest.mark.parametrize("tag", ['', 'null'])
+def test_stream_matches_scores(dataset, tag):
+    #chunks of a few samples, so the stream is scored over several of them
+    cache_codec.dump_ssGSEA_stream(dataset, tag, max_memory=200 * cache_codec.STREAM_BYTES_PER_GENE * 5)
+    set_names, ids, streamed = cache_codec.load_ssGSEA_stream(dataset, tag)
+    scores = cache_codec.load_ssGSEA_scores(dataset, tag)
+
+    assert sorted(set_names) == sorted(scores.keys())
+    expected = np.array([[scores[name][id] for name in set_names] for id in ids])
+    assert np.allclose(streamed, expected, rtol=0, atol=1e-12)
+
+def test_stream_missing_intensity(dataset):
+    connection = sqlite3.connect(cache_codec.EXPRESSION_PROFILE_DB(dataset))
+    connection.execute("Delete From " + cache_codec.EXPRESSION_PROFILE_DBTABLE(dataset) +
+                       " Where Sample = 105 And Gene = 'g7'")
+    connection.commit()
+    connection.close()
+
+    with pytest.raises(ValueError):
+        cache_codec.dump_ssGSEA_stream(dataset, '')
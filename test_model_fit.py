@@ -0,0 +1,41 @@
+'''
+Checks that refitting gene models to a slightly grown cohort keeps most genes warm started
+'''
+
+import numpy as np
+
+import model_fit
+from model_fit import fit_gene_model_table
+from model_fit import refit_gene_model_table
+
+def bimodal_values(rng, genes, samples):
+    '''
+    Returns a genes x samples array drawn from a different two component gaussian mixture for every gene
+    '''
+    means = np.sort(rng.uniform(-3, 3, (genes, 2)), axis=1)
+    scales = rng.uniform(0.3, 1, (genes, 2))
+    components = rng.random((genes, samples)) < rng.uniform(0.2, 0.8, (genes, 1))
+    picks = components.astype(int)
+    return rng.normal(np.take_along_axis(means, picks, axis=1), np.take_along_axis(scales, picks, axis=1))
+
+def test_small_cohort_change_stays_warm(monkeypatch):
+    rng = np.random.default_rng(0)
+    genes = ["g" + str(i) for i in range(120)]
+    values = bimodal_values(rng, len(genes), 45)
+
+    models = fit_gene_model_table(genes, values[:, :40], seed=0)
+
+    #every fit from scratch goes through fit_mixtures with several restarts
+    refitted = []
+    fit_mixtures = model_fit.fit_mixtures
+    def counting_fit_mixtures(values, restarts=5, *args, **kwargs):
+        if restarts > 1:
+            refitted.append(len(values))
+        return fit_mixtures(values, restarts, *args, **kwargs)
+    monkeypatch.setattr(model_fit, "fit_mixtures", counting_fit_mixtures)
+
+    table = refit_gene_model_table(models, genes, values, seed=0)
+
+    assert sum(refitted) <= 0.1 * len(genes)
+    full = fit_gene_model_table(genes, values, seed=0)
+    assert np.median(np.abs(table.log_likelihood - full.log_likelihood)) < 1e-2
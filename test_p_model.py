@@ -0,0 +1,52 @@
+'''
+Checks the tabulated beta distributions of p_model against scipy
+'''
+
+import numpy as np
+from scipy.special import expit
+from scipy.special import logit
+from scipy.stats import beta
+
+from p_model import TABLE_ERROR
+from p_model import beta_table
+from p_model import hHigh
+from p_model import hLow
+from p_model import hMid
+from p_model import pmodel_matrix
+
+def sample_points(count=10 ** 5, bounds=(1e-9, 1 - 1e-9)):
+    '''
+    Returns values spread uniformly in logit space across the tabulated bounds, where both tails are sampled densely,
+    and uniformly across the normalized expressions pmodel_matrix is given.
+    '''
+    rng = np.random.default_rng(0)
+    return np.concatenate([expit(rng.uniform(logit(bounds[0]), logit(bounds[1]), count)),
+                           rng.uniform(0.00001, 0.99999, count)])
+
+def test_beta_table_error():
+    x = sample_points()
+    for h in (hLow, hMid, hHigh):
+        table = beta_table(*h.args)
+        assert table.error <= TABLE_ERROR
+
+        assert np.abs(table.logsf(x) - beta.logsf(x, *h.args)).max() <= TABLE_ERROR
+        assert np.abs(table.logcdf(x) - beta.logcdf(x, *h.args)).max() <= TABLE_ERROR
+
+def test_beta_table_pdf():
+    #the slope of the tabulated cdf between neighbouring points is the average density of the distribution there
+    x = np.sort(np.random.default_rng(1).uniform(0.001, 0.999, 1000))
+    x = np.stack([x, x + 1e-4])
+    for h in (hLow, hMid, hHigh):
+        table = beta_table(*h.args)
+        slopes = np.diff(np.exp(table.logcdf(x)), axis=0)[0] / 1e-4
+        assert np.allclose(slopes, beta.pdf(x.mean(axis=0), *h.args), rtol=1e-2)
+
+def test_tabulated_posteriors():
+    values = np.random.default_rng(2).uniform(0, 1, (200, 30))
+    values[:10, :5] = 0
+    values[10:20, :5] = 1
+
+    exact = pmodel_matrix(values, [1/3, 1/3, 1/3])
+    tabulated = pmodel_matrix(values, [1/3, 1/3, 1/3], tabulated=True)
+
+    assert np.allclose(tabulated, exact, rtol=1e-4, atol=1e-9)